@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of encoding and decoding a feed with the codec, JSON and pickle.
+
+    $ PYTHONPATH=. python benchmarks/codec.py
+
+The feed has 10 datastreams of 1000 datapoints each.  JSON decoding
+includes turning the result back into models, as the API client does.
+
+"""
+
+import json
+import pickle
+import timeit
+
+from datetime import datetime, timedelta
+
+import cosm
+import cosm.api
+import cosm.codec
+
+
+STREAMS = 10
+POINTS = 1000
+
+
+def make_feed():
+    start = datetime(2013, 1, 1, 0, 0, 0, 123456)
+    datastreams = []
+    for i in range(STREAMS):
+        datapoints = [cosm.Datapoint(at=start + timedelta(seconds=n),
+                                     value="{:.2f}".format(n * 0.37))
+                      for n in range(POINTS)]
+        datastreams.append(cosm.Datastream(
+            id=str(i), current_value=datapoints[-1].value,
+            datapoints=datapoints))
+    return cosm.Feed(title="Benchmark", id=504, datastreams=datastreams)
+
+
+def json_loads(data, manager=cosm.api.FeedsManager(cosm.Client("KEY"))):
+    data = json.loads(data)
+    data['feed'] = 'http://api.cosm.com/v2/feeds/504'
+    return manager._coerce_to_feed(data)
+
+
+CODECS = [
+    ('cosm.codec', cosm.codec.dumps, cosm.codec.loads),
+    ('json', lambda feed: json.dumps(feed, cls=cosm.JSONEncoder), json_loads),
+    ('pickle', lambda feed: pickle.dumps(feed, pickle.HIGHEST_PROTOCOL),
+     pickle.loads),
+]
+
+
+def measure(func, arg, number=10):
+    return min(timeit.repeat(lambda: func(arg), number=number,
+                             repeat=3)) / number
+
+
+if __name__ == '__main__':
+    feed = make_feed()
+    print("{:>12} {:>10} {:>10} {:>10}".format(
+        '', 'bytes', 'dumps ms', 'loads ms'))
+    for name, dumps, loads in CODECS:
+        data = dumps(feed)
+        print("{:>12} {:>10} {:>10.2f} {:>10.2f}".format(
+            name, len(data), measure(dumps, feed) * 1000,
+            measure(loads, data) * 1000))
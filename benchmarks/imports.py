@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the time taken to import cosm in a fresh interpreter.
+
+    $ PYTHONPATH=. python benchmarks/imports.py
+
+"""
+
+import subprocess
+import sys
+import time
+
+
+STATEMENTS = [
+    "pass",
+    "import cosm",
+    "import cosm; cosm.Feed(title='Feed')",
+    "import cosm.api",
+]
+
+
+def measure(statement, repeat=10):
+    timings = []
+    for _ in range(repeat):
+        started = time.time()
+        subprocess.check_call([sys.executable, '-c', statement])
+        timings.append(time.time() - started)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    for statement in STATEMENTS:
+        print("{:>8.1f} ms  {}".format(measure(statement) * 1000, statement))
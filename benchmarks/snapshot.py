@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of taking a snapshot of a fleet of feeds from a local server.
+
+    $ PYTHONPATH=. python benchmarks/snapshot.py
+
+The fleet has 5000 feeds of 10 datastreams each, served 100 feeds per page
+with a simulated latency of 50 ms per request.
+
+"""
+
+import json
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    import socketserver  # NOQA
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # NOQA
+    from urllib.parse import parse_qs, urlparse  # NOQA
+
+import cosm.api
+
+
+FEEDS = 5000
+STREAMS = 10
+LATENCY = 0.05
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        ids = parse_qs(urlparse(self.path).query)['ids'][0].split(',')
+        body = json.dumps({'results': [{
+            'id': int(feed_id),
+            'title': "Feed {}".format(feed_id),
+            'datastreams': [{
+                'id': str(n), 'current_value': str(n * 1.5),
+                'at': '2013-01-01T00:00:{:02d}.000000Z'.format(n),
+            } for n in range(STREAMS)],
+        } for feed_id in ids]}).encode('utf8')
+        time.sleep(LATENCY)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    api = cosm.api.Client("KEY", thread_safe=True)
+    api.client.base_url = 'http://127.0.0.1:{}/v2/'.format(
+        server.server_address[1])
+    api.feeds = cosm.api.FeedsManager(api.client)
+    for workers in (1, 8):
+        started = time.time()
+        snapshot = api.feeds.snapshot(range(FEEDS), workers=workers)
+        print("{:>8.2f} s  {} rows, {} workers".format(
+            time.time() - started, len(snapshot['feed']), workers))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the time per request of each transport against a local server.
+
+    $ PYTHONPATH=. python benchmarks/transport.py
+
+The HTTP/2 transport is skipped unless httpx is installed; the local server
+only speaks HTTP/1.1, so it measures httpx's overhead rather than
+multiplexing.
+
+"""
+
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    import socketserver  # NOQA
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # NOQA
+
+import cosm.api
+import cosm.transport
+
+
+FEED = (b'{"id": 504, "title": "Area 51", '
+        b'"feed": "http://api.cosm.com/v2/feeds/504.json", '
+        b'"datastreams": [{"id": "energy", "current_value": "42"}]}')
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(FEED)))
+        self.end_headers()
+        self.wfile.write(FEED)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def measure(transport, url, repeat=1000):
+    api = cosm.api.Client("KEY", transport=transport)
+    api.client.base_url = url + '/v2/'
+    api.feeds = cosm.api.FeedsManager(api.client)
+    api.feeds.get(504)
+    started = time.time()
+    for _ in range(repeat):
+        api.feeds.get(504)
+    return (time.time() - started) / repeat
+
+
+if __name__ == '__main__':
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    transports = [('requests', lambda: None),
+                  ('http.client', cosm.transport.HTTPTransport),
+                  ('httpx (HTTP/2)', cosm.transport.HTTP2Transport)]
+    for name, transport in transports:
+        try:
+            timing = measure(transport(), url)
+        except ImportError as e:
+            print("{:>8}      {} ({})".format('-', name, e))
+            continue
+        print("{:>8.1f} µs  {}".format(timing * 1e6, name))
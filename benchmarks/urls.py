@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of the URL construction done by the managers.
+
+Builds the datapoints manager of many datastreams the way an ingestion loop
+does, then the history and datapoint URLs for each of them.
+
+    $ PYTHONPATH=. python benchmarks/urls.py
+
+"""
+
+import timeit
+
+from datetime import datetime
+
+import cosm
+import cosm.api
+
+
+STREAMS = 100
+
+
+def setup():
+    api = cosm.api.Client("API_KEY")
+    feed = cosm.Feed(title="Benchmark", id=504,
+                     feed="http://api.cosm.com/v2/feeds/504.json")
+    feed._manager = api.feeds
+    return feed
+
+
+def ingest(feed, at=datetime(2013, 2, 22, 12, 14, 40, 123456)):
+    for id in range(STREAMS):
+        datastream = cosm.Datastream(id=str(id))
+        datastream._manager = feed.datastreams
+        datapoints = datastream.datapoints
+        datapoints.history_url
+        datapoints._datapoint_url(at)
+
+
+if __name__ == '__main__':
+    feed = setup()
+    number = 200
+    seconds = min(timeit.repeat(lambda: ingest(feed), number=number, repeat=5))
+    print("{:.2f} us per datastream".format(seconds / number / STREAMS * 1e6))
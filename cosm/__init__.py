@@ -4,73 +4,15 @@ __title__ = 'cosm-python'
 __version__ = '0.1.0'
 
 import json
+import sys
+import threading
 
 from datetime import datetime
 
-try:
-    from urlparse import urljoin
-except ImportError:
-    from urllib.parse import urljoin  # NOQA
 
-from requests.sessions import Session
-
-from requests.auth import AuthBase
-
-
-class KeyAuth(AuthBase):
-    """Attaches HTTP API Key Authentication to the given Request object."""
-    def __init__(self, key):
-        self.key = key
-
-    def __call__(self, r):
-        # modify and return the request
-        r.headers['X-ApiKey'] = self.key
-        return r
-
-
-class Client(Session):
-    """A Cosm API Client object.
-
-    This is instantiated with an API key which is used for all requests to the
-    Cosm API.  It also defines a BASE_URL so that we can specify relative urls
-    when using the client (all requests via this client are going to Cosm).
-
-    """
-    BASE_URL = "http://api.cosm.com"
-
-    def __init__(self, key):
-        super(Client, self).__init__()
-        self.auth = KeyAuth(key)
-        self.base_url = self.BASE_URL
-        self.headers['Content-Type'] = 'application/json'
-        self.headers['User-Agent'] = 'cosm-python/{} {}'.format(
-            __version__, self.headers['User-Agent'])
-
-    def request(self, method, url, *args, **kwargs):
-        """Constructs and sends a Request to the Cosm API.
-
-        Objects that implement __getstate__  will be serialised.
-
-        """
-        full_url = urljoin(self.base_url, url)
-        if 'data' in kwargs:
-            kwargs['data'] = self._encode_data(kwargs['data'])
-        return super(Client, self).request(method, full_url, *args, **kwargs)
-
-    def _encode_data(self, data, **kwargs):
-        """Returns data encoded as JSON using a custom encoder.
-
-        >>> client = Client("XXXXXX")
-        >>> client._encode_data({'foo': datetime(2013, 2, 22, 12, 14, 40)})
-        '{"foo": "2013-02-22T12:14:40Z"}'
-        >>> feed = Feed(id=42, title="The Answer")
-        >>> client._encode_data({'feed': feed}, sort_keys=True)
-        '{"feed": {"id": 42, "title": "The Answer"}}'
-        >>> datastreams = [Datastream(id="1"), Datastream(id="2")]
-        >>> client._encode_data({'datastreams': datastreams})
-        '{"datastreams": [{"id": "1"}, {"id": "2"}]}'
-        """
-        return json.dumps(data, cls=JSONEncoder, **kwargs)
+# Guards the lazy creation of managers; once created they are read without
+# taking it.
+_manager_lock = threading.Lock()
 
 
 class Base(object):
@@ -82,6 +24,9 @@ class Base(object):
     def __getstate__(self):
         return dict(**self._data)
 
+    def __setstate__(self, state):
+        self._data = dict(state)
+
     def __getattr__(self, name):
         try:
             return self._data[name]
@@ -111,10 +56,14 @@ class Feed(Base):
 
     @property
     def datastreams(self):
-        if self._datastreams is None:
-            import cosm.api
-            self._datastreams = cosm.api.DatastreamsManager(self)
-        return self._datastreams
+        manager = self._datastreams
+        if manager is None:
+            with _manager_lock:
+                if self._datastreams is None:
+                    import cosm.api
+                    self._datastreams = cosm.api.DatastreamsManager(self)
+                manager = self._datastreams
+        return manager
 
     @datastreams.setter  # NOQA
     def datastreams(self, datastreams):
@@ -144,13 +93,19 @@ class Datastream(Base):
 
     @property
     def datapoints(self):
-        if self._datapoints is None:
-            import cosm.api
-            self._datapoints = cosm.api.DatapointsManager(self)
-        return self._datapoints
+        manager = self._datapoints
+        if manager is None:
+            with _manager_lock:
+                if self._datapoints is None:
+                    import cosm.api
+                    self._datapoints = cosm.api.DatapointsManager(self)
+                manager = self._datapoints
+        return manager
 
     @datapoints.setter  # NOQA
     def datapoints(self, datapoints):
+        if isinstance(datapoints, list):
+            _sort_by_at(datapoints)
         self._data['datapoints'] = datapoints
 
     def update(self):
@@ -161,6 +116,22 @@ class Datastream(Base):
         self._manager.delete(self.id)
 
 
+def _at(datapoint):
+    if isinstance(datapoint, dict):
+        return datapoint['at']
+    return datapoint.at
+
+
+def _sort_by_at(datapoints):
+    """Sorts Datapoints (or dicts of them) by time, in place."""
+    try:
+        ats = [_at(d) for d in datapoints]
+        if any(a > b for a, b in zip(ats, ats[1:])):
+            datapoints.sort(key=_at)
+    except (AttributeError, KeyError, TypeError):
+        pass  # Not datapoints with comparable times; leave them be.
+
+
 class Datapoint(Base):
     """A Datapoint represents a value at a certain point in time."""
 
@@ -191,6 +162,13 @@ class Trigger(Base):
         if threshold_value is not None:
             self._data['threshold_value'] = threshold_value
 
+    def update(self):
+        state = self.__getstate__()
+        self._manager.update(state.pop('id'), **state)
+
+    def delete(self):
+        self._manager.delete(self.id)
+
 
 class JSONEncoder(json.JSONEncoder):
 
@@ -201,3 +179,26 @@ class JSONEncoder(json.JSONEncoder):
             return obj.__getstate__()
         else:
             return json.JSONEncoder.default(self, obj)
+
+
+# The HTTP client pulls in requests, so it is only imported once used; the
+# models and the JSON encoding above can be used without it.
+_LAZY_ATTRIBUTES = {
+    'Client': 'cosm.client',
+    'KeyAuth': 'cosm.client',
+    'Session': 'cosm.client',
+    'ThreadLocalClient': 'cosm.client',
+}
+
+if sys.version_info < (3, 7):
+    from cosm.client import Client, KeyAuth, Session, ThreadLocalClient  # NOQA
+else:
+    def __getattr__(name):
+        if name not in _LAZY_ATTRIBUTES:
+            raise AttributeError(
+                "module 'cosm' has no attribute '{}'".format(name))
+        import importlib
+        module = importlib.import_module(_LAZY_ATTRIBUTES[name])
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
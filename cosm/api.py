@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import copy
 import json
+import logging
 
-from collections import Sequence
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from operator import attrgetter
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence  # NOQA
 
 try:
     from urlparse import urljoin
@@ -12,17 +21,45 @@ except ImportError:
 
 import cosm
 
+from cosm.utils import map_concurrently
+
 
 DEFAULT_FORMAT = 'json'
 
+log = logging.getLogger(__name__)
+
+
+def _decode_history_columns(datapoints_data):
+    """Returns the at and value columns of raw datapoints as numpy arrays.
+
+    Timestamps are parsed by numpy in one go rather than one by one.
+
+    """
+    import numpy
+    ats = numpy.array([d['at'].rstrip('Z') for d in datapoints_data],
+                      dtype='datetime64[us]')
+    values = numpy.array([d['value'] for d in datapoints_data],
+                         dtype='float64')
+    return ats, values
+
 
 class Client(object):
+    """A Cosm API client.
+
+    With `thread_safe` the client can be shared between threads: each thread
+    sends its requests through a session of its own.
+
+    """
 
     api_version = 'v2'
     client_class = cosm.Client
 
-    def __init__(self, key):
-        self.client = self.client_class(key)
+    def __init__(self, key, thread_safe=False, **kwargs):
+        if thread_safe:
+            self.client = cosm.ThreadLocalClient(
+                lambda: self.client_class(key, **kwargs))
+        else:
+            self.client = self.client_class(key, **kwargs)
         self.client.base_url += '/{}/'.format(self.api_version)
         self.feeds = FeedsManager(self.client)
         self.triggers = TriggersManager(self.client)
@@ -30,13 +67,42 @@ class Client(object):
 
 class ManagerBase(object):
 
+    _url_cache = None
+    _url_cache_size = 4096
+
     def _url(self, url_or_id):
+        return self._memoise(url_or_id, lambda: self._build_url(url_or_id))
+
+    def _build_url(self, url_or_id):
         url = self.base_url
         if url_or_id:
             url += '/'
             url = urljoin(url, str(url_or_id))
         return url
 
+    def _memoise(self, key, build):
+        """Returns the url cached under key, building it on first use."""
+        cache = self._url_cache
+        if cache is None:
+            cache = self._url_cache = {}
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        if len(cache) >= self._url_cache_size:
+            cache.clear()
+        url = cache[key] = build()
+        return url
+
+    def _history_frame(self, columns):
+        import pandas
+        index = pandas.DatetimeIndex(columns.pop('at'), name='at')
+        return pandas.DataFrame(columns, index=index)
+
+    def _history_arrow(self, columns):
+        import pyarrow
+        return pyarrow.table(columns)
+
     def _json_default(self, obj):
         if not isinstance(obj, datetime):
             raise TypeError
@@ -79,9 +145,7 @@ class FeedsManager(ManagerBase):
         response.raise_for_status()
         json = response.json()
         for feed_data in json['results']:
-            feed = cosm.Feed(**feed_data)
-            feed._manager = self
-            yield feed
+            yield self._coerce_to_feed(feed_data)
 
     def get(self, url_or_id, **params):
         url = self._url(url_or_id)
@@ -89,6 +153,92 @@ class FeedsManager(ManagerBase):
         response = self.client.get(url, params=params)
         response.raise_for_status()
         data = response.json()
+        return self._coerce_to_feed(data)
+
+    def delete(self, url_or_id):
+        url = self._url(url_or_id)
+        response = self.client.delete(url)
+        response.raise_for_status()
+
+    def snapshot(self, feed_ids, datastreams=None, per_page=100, workers=8):
+        """Returns the current values of the datastreams of many feeds.
+
+        Feeds are listed by id, `per_page` of them per request, and the
+        requests are sent concurrently.  The result has `feed`,
+        `datastream`, `current_value` and `at` columns of equal length;
+        only those fields are decoded, no models are made.  Given
+        `datastreams` (a list of ids), only those datastreams are included.
+        Feeds which don't exist are left out.
+
+        """
+        feed_ids = [str(feed_id) for feed_id in feed_ids]
+        pages = [feed_ids[i:i + per_page]
+                 for i in range(0, len(feed_ids), per_page)]
+        params, wanted = {}, None
+        if datastreams is not None:
+            wanted = set(str(d) for d in datastreams)
+            params['datastreams'] = ','.join(sorted(wanted))
+        url = self._url(None)
+
+        def fetch(page):
+            response = self.client.get(url, params=dict(
+                params, ids=','.join(page), per_page=len(page)))
+            response.raise_for_status()
+            return response.json()['results']
+
+        columns = OrderedDict(
+            (name, []) for name in ('feed', 'datastream', 'current_value',
+                                    'at'))
+        feed, datastream, current_value, at = columns.values()
+        parse = self._parse_datetime
+        for results in map_concurrently(fetch, pages, workers):
+            for feed_data in results:
+                feed_id = feed_data['id']
+                for data in feed_data.get('datastreams', ()):
+                    if wanted is not None and data['id'] not in wanted:
+                        continue
+                    feed.append(feed_id)
+                    datastream.append(data['id'])
+                    current_value.append(data.get('current_value'))
+                    at.append(parse(data['at']) if 'at' in data else None)
+        return columns
+
+    def history_frame(self, url_or_id, **params):
+        """Returns the history of a feed's datastreams as a DataFrame.
+
+        The frame is indexed by `at` and has `datastream` and `value` columns.
+
+        """
+        return self._history_frame(self._history_columns(url_or_id, params))
+
+    def history_arrow(self, url_or_id, **params):
+        """Returns a pyarrow Table with datastream, at and value columns."""
+        return self._history_arrow(self._history_columns(url_or_id, params))
+
+    def _history_columns(self, url_or_id, params):
+        import numpy
+        url = self._url(url_or_id)
+        params = self._prepare_params(params)
+        response = self.client.get(url, params=params)
+        response.raise_for_status()
+        ids, datapoints_data = [], []
+        for datastream_data in response.json().get('datastreams', []):
+            datastream_datapoints = datastream_data.get('datapoints', [])
+            ids.extend([datastream_data['id']] * len(datastream_datapoints))
+            datapoints_data.extend(datastream_datapoints)
+        ats, values = _decode_history_columns(datapoints_data)
+        return OrderedDict([
+            ('datastream', numpy.array(ids, dtype=object)),
+            ('at', ats),
+            ('value', values),
+        ])
+
+    def _datastreams_url(self, feed_url):
+        return self._memoise(
+            ('datastreams', feed_url),
+            lambda: feed_url.replace('.json', '') + '/datastreams')
+
+    def _coerce_to_feed(self, data):
         datastreams_data = data.pop('datastreams', None)
         feed = cosm.Feed(**data)
         feed._manager = self
@@ -98,36 +248,44 @@ class FeedsManager(ManagerBase):
             feed._data['datastreams'] = datastreams
         return feed
 
-    def delete(self, url_or_id):
-        url = self._url(url_or_id)
-        response = self.client.delete(url)
-        response.raise_for_status()
-
     def _coerce_datastreams(self, datastreams_manager, datastreams_data):
         coerce = datastreams_manager._coerce_to_datastream
         datastreams = []
         for data in datastreams_data:
             datastream = coerce(data)
             datastreams.append(datastream)
+        datastreams_manager._reindex(datastreams)
         return datastreams
 
 
 class DatastreamsManager(Sequence, ManagerBase):
+    """The datastreams of a feed, by position or by id.
+
+    Lookups by id go through an index of the loaded datastreams which is
+    rebuilt whenever the feed's list of datastreams has been replaced.
+
+    """
+
+    _index_state = None
 
     def __init__(self, feed):
         self.feed = feed
         feed_manager = getattr(feed, '_manager', None)
         if feed_manager is not None:
             self.client = feed_manager.client
-            self.base_url = feed.feed.replace('.json', '') + '/datastreams'
+            self.base_url = feed_manager._datastreams_url(feed.feed)
         else:
             self.client = None
 
     def __contains__(self, value):
-        return value in self.datastreams['datastreams']
+        if isinstance(value, cosm.Datastream):
+            value = value.id
+        return value in self._index()
 
     def __getitem__(self, item):
-        return self._datastreams[item]
+        if isinstance(item, (int, slice)):
+            return self._datastreams[item]
+        return self._datastreams[self._index()[item]]
 
     def __len__(self):
         return len(self._datastreams)
@@ -136,15 +294,52 @@ class DatastreamsManager(Sequence, ManagerBase):
     def _datastreams(self):
         return self.feed._data['datastreams']
 
+    def ids(self):
+        """Returns the ids of the loaded datastreams, in order."""
+        return [self._datastream_id(d) for d in self._datastreams]
+
+    def _index(self):
+        datastreams = self.feed._data.get('datastreams', [])
+        state = self._index_state
+        if (state is None or state[0] is not datastreams or
+                len(state[1]) != len(datastreams)):
+            state = self._reindex(datastreams)
+        return state[1]
+
+    def _reindex(self, datastreams):
+        positions = dict(
+            (self._datastream_id(d), i) for i, d in enumerate(datastreams))
+        # Replaced in one assignment so that concurrent readers never see
+        # the positions of another list.
+        state = self._index_state = (datastreams, positions)
+        return state
+
+    def _datastream_id(self, datastream):
+        if isinstance(datastream, dict):
+            return datastream.get('id')
+        return datastream.id
+
     def create(self, id, **kwargs):
         data = {'version': "1.0.0", 'datastreams': [dict(id=id, **kwargs)]}
         response = self.client.post(self.base_url, data=data)
         response.raise_for_status()
         datastream = cosm.Datastream(id=id, **kwargs)
         datastream._manager = self
+        datastreams = self.feed._data.get('datastreams')
+        if datastreams is not None:
+            index = self._index()
+            if id in index:
+                datastreams[index[id]] = datastream
+            else:
+                index[id] = len(datastreams)
+                datastreams.append(datastream)
         return datastream
 
     def update(self, datastream_id, **kwargs):
+        write_behind = self.client.write_behind
+        if write_behind is not None:
+            write_behind.update(self, datastream_id, kwargs)
+            return
         url = self._url(datastream_id)
         response = self.client.put(url, data=kwargs)
         response.raise_for_status()
@@ -172,6 +367,17 @@ class DatastreamsManager(Sequence, ManagerBase):
         url = self._url(url_or_id)
         response = self.client.delete(url)
         response.raise_for_status()
+        datastreams = self.feed._data.get('datastreams')
+        if datastreams is not None:
+            position = self._index().get(url_or_id)
+            if position is not None:
+                del datastreams[position]
+                self._reindex(datastreams)
+
+    def _datapoints_url(self, datastream_id):
+        return self._memoise(
+            ('datapoints', datastream_id),
+            lambda: self._url(datastream_id) + '/datapoints')
 
     def _coerce_datapoints(self, datapoints_manager, datapoints_data):
         coerce = datapoints_manager._coerce_to_datapoint
@@ -194,20 +400,59 @@ class DatastreamsManager(Sequence, ManagerBase):
         return datastream
 
 
+class DatapointsView(Sequence):
+    """A window onto a datastream's loaded datapoints, without copying."""
+
+    def __init__(self, datapoints, start, stop):
+        self._datapoints = datapoints
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return DatapointsView(self._datapoints, self._start + start,
+                                  self._start + max(start, stop))
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        return self._datapoints[self._start + item]
+
+    def __iter__(self):
+        for i in range(self._start, self._stop):
+            yield self._datapoints[i]
+
+
 class DatapointsManager(Sequence, ManagerBase):
+    """The datapoints of a datastream.
+
+    Loaded datapoints are kept sorted by `at` (they are sorted when assigned
+    to the datastream) so that time based lookups bisect a list of their
+    timestamps, which is rebuilt whenever the datastream's datapoints have
+    been replaced.
+
+    """
+
+    _index_state = None
 
     def __init__(self, datastream):
         self.datastream = datastream
         datastream_manager = getattr(datastream, '_manager', None)
         if datastream_manager is not None:
-            self.client = datastream._manager.client
-            datastream_url = datastream._manager._url(datastream.id)
-            self.base_url = datastream_url + '/datapoints'
+            self.client = datastream_manager.client
+            self.history_url = datastream_manager._url(datastream.id)
+            self.base_url = datastream_manager._datapoints_url(datastream.id)
         else:
             self.client = None
 
     def __contains__(self, value):
-        return value in self.datapoints['datapoints']
+        return value in self._datapoints
 
     def __getitem__(self, item):
         return self._datapoints[item]
@@ -219,21 +464,105 @@ class DatapointsManager(Sequence, ManagerBase):
     def _datapoints(self):
         return self.datastream._data['datapoints']
 
+    def between(self, start, end):
+        """Returns a view of the loaded datapoints from start to end."""
+        datapoints, ats = self._time_index()
+        lo = bisect.bisect_left(ats, start)
+        hi = bisect.bisect_right(ats, end)
+        return DatapointsView(datapoints, lo, max(lo, hi))
+
+    def at_or_before(self, at):
+        """Returns the newest loaded datapoint not newer than at, or None."""
+        datapoints, ats = self._time_index()
+        i = bisect.bisect_right(ats, at)
+        return datapoints[i - 1] if i else None
+
+    def nearest(self, at):
+        """Returns the loaded datapoint closest to at, or None."""
+        datapoints, ats = self._time_index()
+        i = bisect.bisect_left(ats, at)
+        if i == len(ats) or (i and at - ats[i - 1] <= ats[i] - at):
+            i -= 1
+        return datapoints[i] if i >= 0 else None
+
+    def windows(self, seconds, start=None, end=None):
+        """Yields (window start, view) pairs of consecutive windows.
+
+        Windows are `seconds` long and cover start (defaulting to the
+        oldest loaded datapoint) up to end (defaulting to the newest).
+
+        """
+        datapoints, ats = self._time_index()
+        if not ats:
+            return
+        step = timedelta(seconds=seconds)
+        window_start = ats[0] if start is None else start
+        end = ats[-1] if end is None else end
+        lo = bisect.bisect_left(ats, window_start)
+        while window_start <= end:
+            window_end = window_start + step
+            hi = bisect.bisect_left(ats, min(window_end, end), lo)
+            if window_end > end:
+                hi = bisect.bisect_right(ats, end, hi)
+            yield window_start, DatapointsView(datapoints, lo, hi)
+            window_start, lo = window_end, hi
+
+    def resample(self, seconds, start=None, end=None):
+        """Returns (at, datapoint) pairs every `seconds` from start to end.
+
+        Each datapoint is the newest loaded one at or before `at` (None if
+        there is none), so values are held until the next datapoint.
+
+        """
+        datapoints, ats = self._time_index()
+        if not ats:
+            return []
+        step = timedelta(seconds=seconds)
+        at = ats[0] if start is None else start
+        end = ats[-1] if end is None else end
+        samples = []
+        i = 0
+        while at <= end:
+            i = bisect.bisect_right(ats, at, i)
+            samples.append((at, datapoints[i - 1] if i else None))
+            at += step
+        return samples
+
+    def _time_index(self):
+        """Returns the loaded datapoints and the list of their timestamps."""
+        datapoints = self.datastream._data.get('datapoints', [])
+        state = self._index_state
+        if (state is None or state[0] is not datapoints or
+                len(state[1]) != len(datapoints)):
+            ats = [d.at for d in datapoints]
+            if ats != sorted(ats):
+                datapoints.sort(key=attrgetter('at'))
+                ats.sort()
+            state = self._index_state = (datapoints, ats)
+        return state
+
     def create(self, datapoints):
         datapoints = [self._coerce_to_datapoint(d) for d in datapoints]
         payload = {'datapoints': datapoints}
         response = self.client.post(self.base_url, data=payload)
         response.raise_for_status()
+        # The datapoints are written by now, so a failing hook must not make
+        # the create look failed (and be retried).
+        for hook in self.client.datapoint_hooks:
+            try:
+                hook(self, datapoints)
+            except Exception:
+                log.exception("Datapoint hook %r failed", hook)
         return datapoints
 
     def update(self, at, value):
-        url = "{}/{}Z".format(self.base_url, at.isoformat())
+        url = self._datapoint_url(at)
         payload = {'value': value}
         response = self.client.put(url, data=payload)
         response.raise_for_status()
 
     def get(self, at):
-        url = "{}/{}Z".format(self.base_url, at.isoformat())
+        url = self._datapoint_url(at)
         response = self.client.get(url)
         response.raise_for_status()
         data = response.json()
@@ -241,24 +570,49 @@ class DatapointsManager(Sequence, ManagerBase):
         return self._coerce_to_datapoint(data)
 
     def history(self, **params):
-        url = self._url('..').rstrip('/')
-        params = self._prepare_params(params)
-        response = self.client.get(url, params=params)
-        response.raise_for_status()
+        response = self._history_response(params)
         data = response.json()
         for datapoint_data in data['datapoints']:
             datapoint_data['at'] = self._parse_datetime(datapoint_data['at'])
             yield self._coerce_to_datapoint(datapoint_data)
 
+    def history_frame(self, **params):
+        """Returns the history as a DataFrame of values indexed by `at`.
+
+        The response is decoded straight into columns without creating a
+        Datapoint for every value.
+
+        """
+        return self._history_frame(self._history_columns(params))
+
+    def history_arrow(self, **params):
+        """Returns the history as a pyarrow Table with at and value columns."""
+        return self._history_arrow(self._history_columns(params))
+
+    def _history_response(self, params):
+        params = self._prepare_params(params)
+        response = self.client.get(self.history_url, params=params)
+        response.raise_for_status()
+        return response
+
+    def _history_columns(self, params):
+        response = self._history_response(params)
+        ats, values = _decode_history_columns(
+            response.json().get('datapoints', []))
+        return OrderedDict([('at', ats), ('value', values)])
+
     def delete(self, at=None, **params):
         url = self.base_url
         if at:
-            url = "{}/{}Z".format(url, at.isoformat())
+            url = self._datapoint_url(at)
         elif params:
             params = self._prepare_params(params)
         response = self.client.delete(url, params=params)
         response.raise_for_status()
 
+    def _datapoint_url(self, at):
+        return self.base_url + '/' + at.isoformat() + 'Z'
+
     def _coerce_to_datapoint(self, d):
         if isinstance(d, cosm.Datapoint):
             datapoint = self._clone_datapoint(d)
@@ -286,12 +640,110 @@ class TriggersManager(ManagerBase):
         trigger._data['id'] = int(location.rsplit('/', 1)[1])
         return trigger
 
+    def update(self, id, **kwargs):
+        url = self._url(id)
+        response = self.client.put(url, data=kwargs)
+        response.raise_for_status()
+
+    def list(self, per_page=100, **params):
+        """Yields every trigger, requesting further pages as needed."""
+        url = self._url(None)
+        params['per_page'] = per_page
+        page = 1
+        while True:
+            params['page'] = page
+            response = self.client.get(url, params=params)
+            response.raise_for_status()
+            triggers_data = response.json()
+            for data in triggers_data:
+                yield self._coerce_to_trigger(data)
+            if len(triggers_data) < per_page:
+                break
+            page += 1
+
     def get(self, id):
         url = self._url(id)
         response = self.client.get(url)
         response.raise_for_status()
         data = response.json()
-        data.pop('id')
+        data['id'] = id
+        return self._coerce_to_trigger(data)
+
+    def delete(self, id):
+        url = self._url(id)
+        response = self.client.delete(url)
+        response.raise_for_status()
+
+    def sync(self, triggers, workers=8):
+        """Makes the triggers on Cosm match the given Trigger objects.
+
+        Triggers are matched on their feed, datastream, url and type.  Only
+        the creates, updates and deletes needed are sent, concurrently.
+        Returns a dict of the created, updated and deleted triggers.
+
+        """
+        existing = {}
+        deleted = []
+        for trigger in self.list():
+            key = self._trigger_key(trigger)
+            if key in existing:
+                deleted.append(trigger)
+            else:
+                existing[key] = trigger
+        created, updated = [], []
+        for trigger in triggers:
+            current = existing.pop(self._trigger_key(trigger), None)
+            if current is None:
+                created.append(trigger)
+            elif self._threshold(current) != self._threshold(trigger):
+                trigger = copy.copy(trigger)
+                trigger._data['id'] = current.id
+                trigger._manager = self
+                updated.append(trigger)
+        deleted.extend(existing.values())
+
+        def apply(operation):
+            action, trigger = operation
+            if action == 'create':
+                return self.create(**trigger.__getstate__())
+            state = trigger.__getstate__()
+            id = state.pop('id')
+            if action == 'update':
+                self.update(id, **state)
+            else:
+                self.delete(id)
+            return trigger
+
+        operations = ([('create', t) for t in created] +
+                      [('update', t) for t in updated] +
+                      [('delete', t) for t in deleted])
+        results = map_concurrently(apply, operations, workers)
+        return {
+            'created': results[:len(created)],
+            'updated': updated,
+            'deleted': deleted,
+        }
+
+    def _threshold(self, trigger):
+        """Returns the threshold of a trigger, as a number if it is one.
+
+        Cosm returns thresholds as strings ("15.0") while they are usually
+        given as numbers.
+
+        """
+        value = trigger._data.get('threshold_value')
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+
+    def _trigger_key(self, trigger):
+        data = trigger._data
+        return (str(data['environment_id']), str(data['stream_id']),
+                data['url'], data['trigger_type'])
+
+    def _coerce_to_trigger(self, data):
+        id = data.pop('id')
         notified_at = data.pop('notified_at', None)
         user = data.pop('user', None)
         trigger = cosm.Trigger(**data)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory caches in front of the datapoints API.
+
+`HistoryCache` remembers which time ranges of a datastream's history have
+been fetched, so that overlapping queries only request what is missing.
+
+    cache = HistoryCache(max_points=1000000)
+    points = cache.history(datastream.datapoints, start=start, end=end)
+
+`RecentValuesStore` keeps the last values of each datastream in a ring buffer
+so that recent values can be read without a request.
+
+    store = RecentValuesStore(capacity=600)
+    store.attach(client)
+    datapoints = store.since(datastream.datapoints, 300)
+
+"""
+
+import bisect
+import threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+#: The most datapoints Cosm returns for one history request.
+PAGE_SIZE = 1000
+
+
+class _History(object):
+    """The fetched ranges of one datastream history and their datapoints."""
+
+    def __init__(self):
+        self.ranges = []
+        self.ats = []
+        self.datapoints = []
+
+    def missing(self, start, end):
+        """Returns the sub-ranges of [start, end] not fetched yet."""
+        missing = []
+        for range_start, range_end in self.ranges:
+            if range_end < start:
+                continue
+            if range_start > end:
+                break
+            if range_start > start:
+                missing.append((start, range_start))
+            start = max(start, range_end)
+        if start < end:
+            missing.append((start, end))
+        return missing
+
+    def add_range(self, start, end):
+        ranges = []
+        for range_start, range_end in self.ranges:
+            if range_end < start or range_start > end:
+                ranges.append((range_start, range_end))
+            else:
+                start = min(start, range_start)
+                end = max(end, range_end)
+        ranges.append((start, end))
+        ranges.sort()
+        self.ranges = ranges
+
+    def add_datapoints(self, datapoints):
+        merged = dict(zip(self.ats, self.datapoints))
+        for datapoint in datapoints:
+            merged[datapoint.at] = datapoint
+        self.ats = sorted(merged)
+        self.datapoints = [merged[at] for at in self.ats]
+
+    def between(self, start, end):
+        lo = bisect.bisect_left(self.ats, start)
+        hi = bisect.bisect_right(self.ats, end)
+        return self.datapoints[lo:hi]
+
+
+class HistoryCache(object):
+    """Caches datastream history by time range.
+
+    Histories are kept per datastream and set of query parameters (such as
+    the `interval` aggregation).  A query only fetches the sub-ranges of
+    [start, end] that have not been fetched before.  Ranges newer than
+    `settle` seconds ago may still change and are never marked as fetched.
+    Ranges are fetched `page_size` datapoints per request, the most Cosm
+    returns at once.  Whole histories are evicted, least recently used
+    first, once more than `max_points` datapoints are held.
+
+    """
+
+    def __init__(self, max_points=100000, settle=60, now=datetime.utcnow,
+                 page_size=PAGE_SIZE):
+        self.max_points = max_points
+        self.settle = timedelta(seconds=settle)
+        self.page_size = page_size
+        self.now = now
+        self.points = 0
+        self.fetches = 0
+        self._histories = OrderedDict()
+        self._lock = threading.Lock()
+
+    def history(self, datapoints_manager, start, end, **params):
+        """Returns the datapoints of a datastream between start and end."""
+        key = (datapoints_manager.history_url,
+               tuple(sorted(params.items())))
+        with self._lock:
+            history = self._histories.pop(key, None) or _History()
+            self._histories[key] = history
+            missing = history.missing(start, end)
+        settled = self.now() - self.settle
+        for fetch_start, fetch_end in missing:
+            datapoints = self._fetch(datapoints_manager, fetch_start,
+                                     fetch_end, params)
+            with self._lock:
+                cached = self._histories.get(key) is history
+                if cached:
+                    self.points -= len(history.ats)
+                history.add_datapoints(datapoints)
+                if cached:
+                    self.points += len(history.ats)
+                if fetch_start < settled:
+                    history.add_range(fetch_start, min(fetch_end, settled))
+        with self._lock:
+            datapoints = history.between(start, end)
+            self._evict(key)
+        return datapoints
+
+    def _fetch(self, datapoints_manager, start, end, params):
+        """Returns the datapoints of [start, end], page by page."""
+        datapoints = []
+        while True:
+            page = list(datapoints_manager.history(
+                start=start, end=end, limit=self.page_size, **params))
+            with self._lock:
+                self.fetches += 1
+            datapoints.extend(page)
+            if len(page) < self.page_size:
+                return datapoints
+            start = page[-1].at + timedelta(microseconds=1)
+
+    def clear(self):
+        with self._lock:
+            self._histories.clear()
+            self.points = 0
+
+    def _evict(self, keep):
+        for key in list(self._histories):
+            if self.points <= self.max_points:
+                break
+            if key != keep:
+                history = self._histories.pop(key)
+                self.points -= len(history.ats)
+
+
+class _Ring(object):
+    """A fixed capacity buffer of (at, value) pairs ordered by time."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ats = [None] * capacity
+        self.values = [None] * capacity
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _index(self, i):
+        return (self.start + i) % self.capacity
+
+    def at(self, i):
+        return self.ats[self._index(i)]
+
+    def get(self, i):
+        index = self._index(i)
+        return self.ats[index], self.values[index]
+
+    def append(self, at, value):
+        if self.size and at <= self.at(self.size - 1):
+            self._insert(at, value)
+            return
+        if self.size == self.capacity:
+            self.start = self._index(1)
+            self.size -= 1
+        index = self._index(self.size)
+        self.ats[index] = at
+        self.values[index] = value
+        self.size += 1
+
+    def _insert(self, at, value):
+        items = [self.get(i) for i in range(self.size)]
+        position = self.bisect(at)
+        if position < self.size and items[position][0] == at:
+            items[position] = (at, value)
+        else:
+            items.insert(position, (at, value))
+        items = items[-self.capacity:]
+        self.start = 0
+        self.size = len(items)
+        for i, (item_at, item_value) in enumerate(items):
+            self.ats[i] = item_at
+            self.values[i] = item_value
+
+    def bisect(self, at):
+        """Returns the position of the first pair not older than at."""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.at(mid) < at:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class RecentValuesStore(object):
+    """Keeps the most recent values of many datastreams in memory.
+
+    Each datastream gets a ring buffer of `capacity` values, filled by the
+    datapoints written through an attached client and by `refresh`.  At most
+    `max_streams` datastreams are held, the least recently used is dropped
+    first, bounding the store at `capacity * max_streams` values.
+
+    """
+
+    def __init__(self, capacity=1000, max_streams=10000, now=datetime.utcnow):
+        self.capacity = capacity
+        self.max_streams = max_streams
+        self.now = now
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def attach(self, api):
+        """Records the datapoints created through an API client."""
+        api.client.datapoint_hooks.append(self.record)
+
+    def record(self, datapoints_manager, datapoints):
+        with self._lock:
+            ring = self._ring(datapoints_manager, create=True)
+            for datapoint in datapoints:
+                ring.append(datapoint.at, datapoint.value)
+
+    def refresh(self, datapoints_manager, **params):
+        """Fetches the datapoints newer than the newest one held."""
+        with self._lock:
+            ring = self._ring(datapoints_manager)
+            newest = ring.at(len(ring) - 1) if ring else None
+        if newest is not None:
+            params.setdefault('start', newest)
+        datapoints = datapoints_manager.history(**params)
+        self.record(datapoints_manager,
+                    [d for d in datapoints if newest is None or d.at > newest])
+
+    def current(self, datapoints_manager):
+        """Returns the newest Datapoint held, or None."""
+        datapoints = self.last(datapoints_manager, 1)
+        return datapoints[0] if datapoints else None
+
+    def last(self, datapoints_manager, n):
+        """Returns up to the n newest Datapoints, oldest first."""
+        with self._lock:
+            ring = self._ring(datapoints_manager)
+            items = [ring.get(i) for i in range(max(0, len(ring) - n),
+                                                len(ring))]
+        return self._datapoints(datapoints_manager, items)
+
+    def since(self, datapoints_manager, seconds):
+        """Returns the Datapoints of the last `seconds`, oldest first."""
+        start = self.now() - timedelta(seconds=seconds)
+        with self._lock:
+            ring = self._ring(datapoints_manager)
+            items = [ring.get(i) for i in range(ring.bisect(start),
+                                                len(ring))]
+        return self._datapoints(datapoints_manager, items)
+
+    def _ring(self, datapoints_manager, create=False):
+        key = datapoints_manager.history_url
+        ring = self._rings.pop(key, None)
+        if ring is None:
+            if not create:
+                return _Ring(0)
+            ring = _Ring(self.capacity)
+            while len(self._rings) >= self.max_streams:
+                self._rings.popitem(last=False)
+        self._rings[key] = ring
+        return ring
+
+    def _datapoints(self, datapoints_manager, items):
+        coerce = datapoints_manager._coerce_to_datapoint
+        return [coerce({'at': at, 'value': value}) for at, value in items]
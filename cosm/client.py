@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""The HTTP client used to talk to the Cosm API."""
+
+import functools
+import itertools
+import json
+import threading
+import weakref
+import zlib
+
+from datetime import datetime  # NOQA
+
+try:
+    from urlparse import urljoin
+except ImportError:
+    from urllib.parse import urljoin  # NOQA
+
+from requests.models import Response
+from requests.sessions import Session
+
+from requests.auth import AuthBase
+
+from cosm import Datastream, Feed, JSONEncoder, __version__  # NOQA
+from cosm.scheduler import current_priority
+
+
+class KeyAuth(AuthBase):
+    """Attaches HTTP API Key Authentication to the given Request object."""
+    def __init__(self, key):
+        self.key = key
+
+    def __call__(self, r):
+        # modify and return the request
+        r.headers['X-ApiKey'] = self.key
+        return r
+
+
+class _TransportRequest(object):
+    """The headers of a request sent by a transport, for auth handlers."""
+
+    def __init__(self, headers):
+        self.headers = dict(headers)
+
+
+class Client(Session):
+    """A Cosm API Client object.
+
+    This is instantiated with an API key which is used for all requests to the
+    Cosm API.  It also defines a BASE_URL so that we can specify relative urls
+    when using the client (all requests via this client are going to Cosm).
+
+    Callables in `datapoint_hooks` are called with the DatapointsManager and
+    the Datapoints after each successful datapoints create.
+
+    Given a `transport` (see `cosm.transport`) requests are sent through it
+    rather than through requests' machinery.
+
+    Datastream updates are deferred to `write_behind` when one is attached
+    (see `cosm.writebehind`), and requests are admitted by priority by an
+    attached `scheduler` (see `cosm.scheduler`).  An attached `resilience`
+    hedges slow GETs and fails fast on failing endpoints (see
+    `cosm.resilience`).
+
+    """
+    BASE_URL = "http://api.cosm.com"
+
+    def __init__(self, key, compress_threshold=None, accept_compressed=True,
+                 transport=None):
+        super(Client, self).__init__()
+        self.transport = transport
+        self.auth = KeyAuth(key)
+        self.base_url = self.BASE_URL
+        self.compress_threshold = compress_threshold
+        self.datapoint_hooks = []
+        self.write_behind = None
+        self.scheduler = None
+        self.resilience = None
+        self.compression_stats = dict.fromkeys([
+            'requests_compressed', 'request_bytes', 'request_bytes_sent',
+            'responses_compressed', 'response_bytes',
+            'response_bytes_received'], 0)
+        self.headers['Content-Type'] = 'application/json'
+        self.headers['Accept-Encoding'] = (
+            'gzip, deflate' if accept_compressed else 'identity')
+        self.headers['User-Agent'] = 'cosm-python/{} {}'.format(
+            __version__, self.headers['User-Agent'])
+
+    def request(self, method, url, *args, **kwargs):
+        """Constructs and sends a Request to the Cosm API.
+
+        Objects that implement __getstate__  will be serialised.  When a
+        `compress_threshold` is set, bodies of at least that many bytes are
+        sent gzip compressed.  A `priority` is passed on to the scheduler.
+
+        """
+        send = self._request
+        priority = kwargs.pop('priority', None)
+        if self.scheduler is not None:
+            send = functools.partial(self.scheduler.call,
+                                     priority or current_priority(),
+                                     self._request)
+        if self.resilience is not None:
+            return self.resilience.call(method, url, send, *args, **kwargs)
+        return send(method, url, *args, **kwargs)
+
+    def _request(self, method, url, *args, **kwargs):
+        full_url = urljoin(self.base_url, url)
+        if 'data' in kwargs:
+            if self.compress_threshold is None:
+                kwargs['data'] = self._encode_data(kwargs['data'])
+            else:
+                body, encoding = self._encode_body(kwargs['data'])
+                kwargs['data'] = body
+                if encoding:
+                    headers = dict(kwargs.get('headers') or {})
+                    headers['Content-Encoding'] = encoding
+                    kwargs['headers'] = headers
+        if self.transport is not None:
+            response = self._transport_request(method, full_url, **kwargs)
+        else:
+            response = super(Client, self).request(
+                method, full_url, *args, **kwargs)
+        if not kwargs.get('stream'):
+            self._count_response(response)
+        return response
+
+    def close(self):
+        super(Client, self).close()
+        if self.transport is not None:
+            self.transport.close()
+
+    def bytes_saved(self):
+        """Returns the number of bytes compression saved on the wire."""
+        stats = self.compression_stats
+        return (stats['request_bytes'] - stats['request_bytes_sent'] +
+                stats['response_bytes'] - stats['response_bytes_received'])
+
+    def _transport_request(self, method, url, params=None, data=None,
+                           headers=None, timeout=None, **kwargs):
+        request = _TransportRequest(self.headers)
+        request.headers.update(headers or {})
+        if self.auth is not None:
+            request = self.auth(request)
+        return self.transport.request(method, url, params=params, data=data,
+                                      headers=request.headers,
+                                      timeout=timeout)
+
+    def _encode_body(self, data):
+        """Returns data encoded as JSON, compressed above the threshold.
+
+        The JSON is produced incrementally and fed to the compressor as it
+        is generated, so a large body is only ever held compressed.
+
+        """
+        chunks = JSONEncoder().iterencode(data)
+        pending, size = [], 0
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= self.compress_threshold:
+                break
+        else:
+            return ''.join(pending), None
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed, size = [], 0
+        for chunk in itertools.chain(pending, chunks):
+            chunk = chunk.encode('utf8')
+            size += len(chunk)
+            compressed.append(compressor.compress(chunk))
+        compressed.append(compressor.flush())
+        body = b''.join(compressed)
+        stats = self.compression_stats
+        stats['requests_compressed'] += 1
+        stats['request_bytes'] += size
+        stats['request_bytes_sent'] += len(body)
+        return body, 'gzip'
+
+    def _count_response(self, response):
+        if not isinstance(response, Response):
+            return
+        encoding = response.headers.get('Content-Encoding')
+        length = response.headers.get('Content-Length')
+        if encoding in ('gzip', 'deflate') and length:
+            stats = self.compression_stats
+            stats['responses_compressed'] += 1
+            stats['response_bytes'] += len(response.content)
+            stats['response_bytes_received'] += int(length)
+
+    def _encode_data(self, data, **kwargs):
+        """Returns data encoded as JSON using a custom encoder.
+
+        >>> client = Client("XXXXXX")
+        >>> client._encode_data({'foo': datetime(2013, 2, 22, 12, 14, 40)})
+        '{"foo": "2013-02-22T12:14:40Z"}'
+        >>> feed = Feed(id=42, title="The Answer")
+        >>> client._encode_data({'feed': feed}, sort_keys=True)
+        '{"feed": {"id": 42, "title": "The Answer"}}'
+        >>> datastreams = [Datastream(id="1"), Datastream(id="2")]
+        >>> client._encode_data({'datastreams': datastreams})
+        '{"datastreams": [{"id": "1"}, {"id": "2"}]}'
+        """
+        return json.dumps(data, cls=JSONEncoder, **kwargs)
+
+
+class ThreadLocalClient(object):
+    """Gives every thread its own Cosm API client.
+
+    A session's headers, cookies and connection pool are not meant to be
+    shared between threads, so each thread calling `request` gets a client
+    of its own made by `factory`.  The `base_url`, `datapoint_hooks`,
+    `write_behind`, `scheduler` and `resilience` of all of them are kept
+    here, as are adapters given to `mount`; other attributes (and other
+    methods changing a session) are those of the calling thread's client.
+
+    The clients of threads which have ended are closed and dropped when the
+    next thread gets its client.
+
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.datapoint_hooks = []
+        self.write_behind = None
+        self.scheduler = None
+        self.resilience = None
+        self._clients = []
+        self._adapters = []
+        self._base_url = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def clients(self):
+        """The clients of all threads."""
+        with self._lock:
+            return [client for _, client in self._clients]
+
+    @property
+    def client(self):
+        """The client of the calling thread."""
+        try:
+            return self._local.client
+        except AttributeError:
+            pass
+        client = self.factory()
+        with self._lock:
+            if self._base_url is None:
+                self._base_url = client.base_url
+            client.base_url = self._base_url
+            for prefix, adapter in self._adapters:
+                client.mount(prefix, adapter)
+            finished = [c for thread, c in self._clients
+                        if not _alive(thread)]
+            self._clients = [(thread, c) for thread, c in self._clients
+                             if _alive(thread)]
+            self._clients.append(
+                (weakref.ref(threading.current_thread()), client))
+        for finished_client in finished:
+            finished_client.close()
+        self._local.client = client
+        return client
+
+    def mount(self, prefix, adapter):
+        """Mounts a transport adapter on the clients of all threads."""
+        with self._lock:
+            self._adapters.append((prefix, adapter))
+            clients = [client for _, client in self._clients]
+        for client in clients:
+            client.mount(prefix, adapter)
+
+    @property
+    def base_url(self):
+        if self._base_url is None:
+            return self.client.base_url
+        return self._base_url
+
+    @base_url.setter  # NOQA
+    def base_url(self, base_url):
+        with self._lock:
+            self._base_url = base_url
+            for _, client in self._clients:
+                client.base_url = base_url
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        send = self._send
+        priority = kwargs.pop('priority', None)
+        if self.scheduler is not None:
+            send = functools.partial(self.scheduler.call,
+                                     priority or current_priority(), send)
+        if self.resilience is not None:
+            return self.resilience.call(method, url, send, **kwargs)
+        return send(method, url, **kwargs)
+
+    def _send(self, method, url, **kwargs):
+        # Looks up the client when sending, as hedged requests are sent
+        # from other threads.
+        return self.client.request(method, url, **kwargs)
+
+    def close(self):
+        """Closes the clients of all threads."""
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for _, client in clients:
+            client.close()
+
+
+def _alive(thread_ref):
+    thread = thread_ref()
+    return thread is not None and thread.is_alive()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+A compact binary encoding of the models, for caches and worker processes.
+
+Models are encoded with msgpack (`pip install msgpack`).  Datetimes are
+stored as 64 bit microseconds since the epoch, and the datapoints of a
+datastream as one packed array of timestamps next to a list of values.
+Loaded objects can be bound to the managers of an API client again, so that
+they can be updated or deleted:
+
+    data = dumps(feed)
+    feed = loads(data, api=client)
+    feed.datastreams[0].datapoints.create([...])
+
+"""
+
+import struct
+
+from datetime import datetime, timedelta
+
+import cosm
+
+
+VERSION = 1
+
+FEED, DATASTREAM, DATAPOINT, TRIGGER, LIST = range(5)
+
+#: msgpack extension type of datetimes nested in model data.
+DATETIME_EXT = 1
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _to_microseconds(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_microseconds(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+def _pack_datetime(obj):
+    import msgpack
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(
+            DATETIME_EXT, struct.pack('>q', _to_microseconds(obj)))
+    raise TypeError("Cannot encode {!r}".format(obj))
+
+
+def _unpack_datetime(code, data):
+    import msgpack
+    if code == DATETIME_EXT:
+        return _from_microseconds(struct.unpack('>q', data)[0])
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj):
+    """Returns a model, or a list of models, encoded as bytes."""
+    import msgpack
+    return msgpack.packb([VERSION, _encode(obj)], default=_pack_datetime,
+                         use_bin_type=True)
+
+
+def loads(data, api=None):
+    """Returns the model(s) encoded in data.
+
+    Given an API client the models are bound to its managers.
+
+    """
+    import msgpack
+    version, encoded = msgpack.unpackb(
+        data, ext_hook=_unpack_datetime, raw=False, strict_map_key=False)
+    if version != VERSION:
+        raise ValueError("Unsupported codec version {!r}".format(version))
+    return _decode(encoded, api)
+
+
+def _encode(obj):
+    if isinstance(obj, (list, tuple)):
+        return [LIST, [_encode(o) for o in obj]]
+    if isinstance(obj, cosm.Feed):
+        data = dict(obj._data)
+        datastreams = data.pop('datastreams', None)
+        if datastreams is not None:
+            datastreams = [_encode_datastream(d) for d in datastreams]
+        return [FEED, data, datastreams]
+    if isinstance(obj, cosm.Datastream):
+        return [DATASTREAM, _encode_datastream(obj), _feed_url(obj)]
+    if isinstance(obj, cosm.Datapoint):
+        data = dict(obj._data)
+        at = data.pop('at')
+        manager = getattr(obj, '_manager', None)
+        context = None
+        if manager is not None:
+            context = [_feed_url(manager.datastream), manager.datastream.id]
+        return [DATAPOINT, _to_microseconds(at), data, context]
+    if isinstance(obj, cosm.Trigger):
+        return [TRIGGER, dict(obj._data)]
+    raise TypeError("Cannot encode {!r}".format(obj))
+
+
+def _encode_datastream(datastream):
+    data = dict(datastream._data)
+    datapoints = data.pop('datapoints', None)
+    if datapoints is None:
+        return [data, None, None]
+    ats, values = [], []
+    for datapoint in datapoints:
+        point = datapoint._data
+        delta = point['at'] - EPOCH
+        ats.append((delta.days * 86400 + delta.seconds) * 1000000 +
+                   delta.microseconds)
+        values.append(point['value'])
+    return [data, struct.pack('>{}q'.format(len(ats)), *ats), values]
+
+
+def _feed_url(datastream):
+    """Returns the url of the feed a datastream is bound to, if any."""
+    manager = getattr(datastream, '_manager', None)
+    if manager is None:
+        return None
+    return manager.feed._data.get('feed')
+
+
+def _decode(encoded, api):
+    kind = encoded[0]
+    if kind == LIST:
+        return [_decode(e, api) for e in encoded[1]]
+    if kind == FEED:
+        _, data, datastreams = encoded
+        feed = _model(cosm.Feed, data)
+        if api is not None:
+            feed._manager = api.feeds
+        if datastreams is not None:
+            manager = _datastreams_manager(feed, api)
+            feed._data['datastreams'] = [
+                _decode_datastream(d, manager) for d in datastreams]
+        return feed
+    if kind == DATASTREAM:
+        _, datastream, feed_url = encoded
+        return _decode_datastream(
+            datastream, _datastreams_manager(_bound_feed(feed_url, api), api))
+    if kind == DATAPOINT:
+        _, at, data, context = encoded
+        data['at'] = _from_microseconds(at)
+        datapoint = _model(cosm.Datapoint, data)
+        if api is not None and context is not None:
+            feed_url, datastream_id = context
+            datastream = cosm.Datastream(id=datastream_id)
+            datastream._manager = _datastreams_manager(
+                _bound_feed(feed_url, api), api)
+            datapoint._manager = datastream.datapoints
+        return datapoint
+    if kind == TRIGGER:
+        trigger = _model(cosm.Trigger, encoded[1])
+        if api is not None:
+            trigger._manager = api.triggers
+        return trigger
+    raise ValueError("Unknown model kind {!r}".format(kind))
+
+
+def _bound_feed(feed_url, api):
+    """Returns a feed standing in for the one at feed_url."""
+    if api is None or feed_url is None:
+        return None
+    feed = _model(cosm.Feed, {'feed': feed_url})
+    feed._manager = api.feeds
+    return feed
+
+
+def _datastreams_manager(feed, api):
+    if api is None or feed is None or 'feed' not in feed._data:
+        return None
+    return feed.datastreams
+
+
+def _decode_datastream(encoded, manager):
+    data, ats, values = encoded
+    datastream = _model(cosm.Datastream, data)
+    if manager is not None:
+        datastream._manager = manager
+    if values is None:
+        return datastream
+    datapoints_manager = None
+    if manager is not None:
+        datapoints_manager = datastream.datapoints
+    ats = struct.unpack('>{}q'.format(len(values)), ats)
+    # Datapoints are built by filling in their __dict__, as going through
+    # Base.__setattr__ for each of them dominates the decoding time.
+    new = cosm.Datapoint.__new__
+    datapoints = []
+    for at, value in zip(ats, values):
+        datapoint = new(cosm.Datapoint)
+        attributes = datapoint.__dict__
+        attributes['_data'] = {'at': EPOCH + timedelta(0, 0, at),
+                               'value': value}
+        if datapoints_manager is not None:
+            attributes['_manager'] = datapoints_manager
+        datapoints.append(datapoint)
+    datastream._data['datapoints'] = datapoints
+    return datastream
+
+
+def _model(cls, data):
+    """Returns a model holding data, without going through __init__."""
+    obj = cls.__new__(cls)
+    obj.__dict__['_data'] = data
+    return obj
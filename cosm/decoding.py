@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decoding large responses in worker processes.
+
+JSON decoding and timestamp parsing of big history and feed list responses
+is CPU bound.  A `DecodePool` fetches responses in the calling thread and
+hands the raw bytes to a process pool, which returns compact columns:
+timestamps as 64 bit integers of microseconds since the epoch and values as
+`array('d')`.
+
+    pool = DecodePool()
+    columns = pool.history(datastream.datapoints, duration="1day")
+    columns['at'][0], columns['value'][0]
+
+"""
+
+import json
+import multiprocessing
+
+from array import array
+from datetime import datetime, timedelta
+
+
+EPOCH = datetime(1970, 1, 1)
+
+# The 'q' typecode only exists from Python 3.3 on; Python 2's 'l' is 64 bits
+# wide on most platforms but not on Windows, where plain lists are used.
+try:
+    array('q')
+    INT64 = 'q'
+except ValueError:
+    INT64 = 'l' if array('l').itemsize >= 8 else None
+
+
+def int64_array(values=()):
+    """Returns an array of 64 bit integers, or a list if there is none."""
+    if INT64 is None:
+        return list(values)
+    return array(INT64, values)
+
+
+def parse_timestamp(value):
+    """Returns microseconds since the epoch of a Cosm UTC timestamp."""
+    seconds = (datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]),
+                        int(value[17:19])) - EPOCH)
+    micros = ((seconds.days * 86400 + seconds.seconds) * 1000000)
+    if value[19:20] == '.':
+        micros += int(value[20:26].ljust(6, '0'))
+    return micros
+
+
+def to_datetime(micros):
+    """Returns the datetime of microseconds since the epoch."""
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def decode_history(content):
+    """Decodes a datastream history response into at and value columns."""
+    datapoints = json.loads(content.decode('utf8')).get('datapoints', [])
+    return {
+        'at': int64_array([parse_timestamp(d['at']) for d in datapoints]),
+        'value': array('d', [_float(d['value']) for d in datapoints]),
+    }
+
+
+def decode_feeds(content):
+    """Decodes a feed list response into columns of datastream values.
+
+    Every row holds a feed id, datastream id, current value and timestamp,
+    with values that are not numbers decoded as NaN.
+
+    """
+    columns = {
+        'feed': int64_array(),
+        'datastream': [],
+        'current_value': array('d'),
+        'at': int64_array(),
+    }
+    for feed in json.loads(content.decode('utf8')).get('results', []):
+        for datastream in feed.get('datastreams', []):
+            columns['feed'].append(feed['id'])
+            columns['datastream'].append(datastream['id'])
+            columns['current_value'].append(
+                _float(datastream.get('current_value')))
+            at = datastream.get('at')
+            columns['at'].append(parse_timestamp(at) if at else 0)
+    return columns
+
+
+class DecodePool(object):
+    """Fetches responses in the calling thread, decodes them in processes.
+
+    Several threads may share a pool to overlap their network I/O while the
+    decoding is spread over all cores.
+
+    """
+
+    def __init__(self, processes=None):
+        self._pool = multiprocessing.Pool(processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def history(self, datapoints_manager, **params):
+        """Returns the history of a datastream as at and value columns."""
+        response = datapoints_manager._history_response(params)
+        return self._pool.apply(decode_history, (response.content,))
+
+    def feeds(self, feeds_manager, **params):
+        """Returns the datastreams of listed feeds as columns."""
+        response = feeds_manager.client.get(feeds_manager._url(None),
+                                            params=params)
+        response.raise_for_status()
+        return self._pool.apply(decode_feeds, (response.content,))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
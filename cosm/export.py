@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk export of datastream history to compressed files.
+
+The requested time range of every datastream is split into windows which are
+fetched concurrently.  Each window is streamed to its own file, written under
+a temporary name and recorded in a checkpoint file once complete, so that an
+interrupted export resumes where it stopped:
+
+    $ cosm-export --key KEY --start 2012-01-01 --end 2013-01-01 \\
+          --output archive 504 61916:random5
+
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+import cosm
+import cosm.api
+
+from cosm.utils import RateLimiter, map_concurrently
+
+
+#: Most datapoints Cosm returns from one raw history request.
+PAGE_SIZE = 1000
+
+FORMATS = ('csv', 'ndjson', 'parquet')
+
+CHECKPOINT = '.cosm-export.json'
+
+
+def parse_datetime(value):
+    """Parses a date or (UTC) date and time given on the command line."""
+    for format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ",
+                   "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date: {!r}".format(value))
+
+
+def format_datetime(value):
+    return value.isoformat() + 'Z'
+
+
+def open_output(path):
+    """Opens a gzip compressed file for writing text.
+
+    On Python 2 the csv and json modules produce byte strings, so the file
+    is left in binary mode there.
+
+    """
+    f = gzip.open(path, 'wb')
+    if sys.version_info < (3,):
+        return f
+    return io.TextIOWrapper(f, newline='')
+
+
+class Exporter(object):
+    """Exports the history of datastreams into `output`, window by window."""
+
+    def __init__(self, api, output, format='csv', window=21600, workers=8,
+                 rate=None, log=sys.stderr):
+        if format not in FORMATS:
+            raise ValueError("Unknown format {!r}".format(format))
+        self.api = api
+        self.output = output
+        self.format = format
+        self.window = timedelta(seconds=window)
+        self.workers = workers
+        self.limiter = RateLimiter(rate) if rate else None
+        self.log = log
+        self.points = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._checkpoint_path = os.path.join(output, CHECKPOINT)
+        self._done = set()
+        if os.path.exists(self._checkpoint_path):
+            with open(self._checkpoint_path) as f:
+                self._done = set(json.load(f))
+
+    def run(self, streams, start, end):
+        """Exports (feed_id, datastream_id or None) streams from start to end.
+
+        Returns the number of datapoints written.
+
+        """
+        datastreams = []
+        for feed_id, datastream_id in streams:
+            feed = self.api.feeds.get(feed_id)
+            if datastream_id is None:
+                datastreams.extend(feed._data.get('datastreams', []))
+            else:
+                datastream = cosm.Datastream(id=datastream_id)
+                datastream._manager = feed.datastreams
+                datastreams.append(datastream)
+        windows = []
+        for datastream in datastreams:
+            window_start = start
+            while window_start < end:
+                window_end = min(window_start + self.window, end)
+                name = self._name(datastream, window_start, window_end)
+                if name not in self._done:
+                    windows.append((datastream, window_start, window_end))
+                window_start = window_end
+        started = time.time()
+        map_concurrently(self._export_window, windows, self.workers)
+        elapsed = max(time.time() - started, 1e-6)
+        self.log.write("{} datapoints in {} requests, {:.0f} points/s\n"
+                       .format(self.points, self.requests,
+                               self.points / elapsed))
+        return self.points
+
+    def _name(self, datastream, start, end):
+        feed = datastream._manager.feed
+        return '{}/{}/{}_{}.{}'.format(
+            feed.id, datastream.id, start.strftime('%Y%m%dT%H%M%S'),
+            end.strftime('%Y%m%dT%H%M%S'),
+            'parquet' if self.format == 'parquet' else self.format + '.gz')
+
+    def _fetch(self, datapoints, start, end):
+        """Yields the raw datapoints of [start, end), page by page."""
+        last = end - timedelta(microseconds=1)
+        while start <= last:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            page = list(datapoints.history(start=start, end=last, interval=0,
+                                           limit=PAGE_SIZE))
+            with self._lock:
+                self.requests += 1
+            for datapoint in page:
+                yield datapoint
+            if len(page) < PAGE_SIZE:
+                break
+            start = page[-1].at + timedelta(microseconds=1)
+
+    def _export_window(self, window):
+        datastream, start, end = window
+        name = self._name(datastream, start, end)
+        path = os.path.join(self.output, name)
+        directory = os.path.dirname(path)
+        with self._lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        datapoints = self._fetch(datastream.datapoints, start, end)
+        writer = getattr(self, '_write_' + self.format)
+        count = writer(path + '.tmp', datapoints)
+        os.rename(path + '.tmp', path)
+        with self._lock:
+            self.points += count
+            self._done.add(name)
+            with open(self._checkpoint_path + '.tmp', 'w') as f:
+                json.dump(sorted(self._done), f)
+            os.rename(self._checkpoint_path + '.tmp', self._checkpoint_path)
+
+    def _write_csv(self, path, datapoints):
+        count = 0
+        with open_output(path) as f:
+            writer = csv.writer(f)
+            writer.writerow(['at', 'value'])
+            for datapoint in datapoints:
+                writer.writerow([format_datetime(datapoint.at),
+                                 datapoint.value])
+                count += 1
+        return count
+
+    def _write_ndjson(self, path, datapoints):
+        count = 0
+        with open_output(path) as f:
+            for datapoint in datapoints:
+                f.write(json.dumps({'at': format_datetime(datapoint.at),
+                                    'value': datapoint.value}) + '\n')
+                count += 1
+        return count
+
+    def _write_parquet(self, path, datapoints):
+        import pyarrow
+        import pyarrow.parquet
+        ats, values = [], []
+        for datapoint in datapoints:
+            ats.append(datapoint.at)
+            values.append(datapoint.value)
+        table = pyarrow.table({
+            'at': pyarrow.array(ats, pyarrow.timestamp('us')),
+            'value': pyarrow.array(values, pyarrow.string()),
+        })
+        pyarrow.parquet.write_table(table, path)
+        return len(ats)
+
+
+def parse_stream(value):
+    """Parses FEED or FEED:DATASTREAM."""
+    feed_id, _, datastream_id = value.partition(':')
+    return int(feed_id), datastream_id or None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='cosm-export',
+        description="Export the history of Cosm datastreams.")
+    parser.add_argument('streams', nargs='+', type=parse_stream,
+                        metavar='FEED[:DATASTREAM]')
+    parser.add_argument('--key', default=os.environ.get('COSM_API_KEY'),
+                        help="API key, defaults to $COSM_API_KEY")
+    parser.add_argument('--start', type=parse_datetime, required=True)
+    parser.add_argument('--end', type=parse_datetime, required=True)
+    parser.add_argument('--output', default='.')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--window', type=int, default=21600,
+                        help="seconds of history per file")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float,
+                        help="maximum requests per second")
+    args = parser.parse_args(argv)
+    if not args.key:
+        parser.error("an API key is required")
+    exporter = Exporter(cosm.api.Client(args.key), args.output,
+                        format=args.format, window=args.window,
+                        workers=args.workers, rate=args.rate)
+    exporter.run(args.streams, args.start, args.end)
+
+
+if __name__ == '__main__':
+    main()
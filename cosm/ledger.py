@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Idempotent datapoint writes.
+
+When a datapoints POST times out it is unknown whether Cosm stored the
+datapoints.  `WriteLedger` keeps track of the batches in flight so that an
+ambiguous failure is resolved by reading back the batch's time window and
+only sending the datapoints that are missing.
+
+    ledger = WriteLedger()
+    ledger.create(datastream.datapoints, datapoints)
+
+"""
+
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+import cosm
+
+
+class _Batch(object):
+    """The datapoints of a batch in flight and the outcome of its write."""
+
+    def __init__(self, points):
+        self.points = points
+        self.written = False
+        self.done = threading.Event()
+
+
+class WriteLedger(object):
+    """Records datapoint batches in flight and resolves ambiguous failures.
+
+    Batches are keyed by datastream, time range and a hash of their content.
+    Datapoints with the same `at` are collapsed (the last one wins), and
+    datapoints already pending in another batch of the same datastream are
+    not sent twice: the other batch's write is waited for, and they are only
+    sent again if it failed.
+
+    """
+
+    #: Server errors after which the datapoints may or may not be stored.
+    AMBIGUOUS_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, verify_retries=2):
+        self.verify_retries = verify_retries
+        self.stats = dict.fromkeys(
+            ['batches', 'collapsed', 'ambiguous', 'resent'], 0)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self):
+        """Returns the keys of the batches currently being written."""
+        with self._lock:
+            return [key for batches in self._pending.values()
+                    for key in batches]
+
+    def create(self, datapoints_manager, datapoints):
+        """Creates datapoints, verifying the write if its outcome is unknown.
+
+        Returns the Datapoints that were sent.
+
+        """
+        datapoints = list(datapoints)
+        points = OrderedDict()
+        for datapoint in datapoints:
+            if isinstance(datapoint, dict):
+                datapoint = cosm.Datapoint(**datapoint)
+            points[datapoint.at] = datapoint.value
+        stream = datapoints_manager.history_url
+        while True:
+            with self._lock:
+                other = self._sharing(stream, points)
+                if other is None:
+                    collapsed = len(datapoints) - len(points)
+                    self.stats['collapsed'] += collapsed
+                    if not points:
+                        return []
+                    pending = self._pending.setdefault(stream, {})
+                    key = self._key(stream, points)
+                    batch = pending[key] = _Batch(points)
+                    self.stats['batches'] += 1
+                    break
+            # The other batch is out of the ledger once done; if its write
+            # failed the shared datapoints are sent with this batch.
+            other.done.wait()
+            if other.written:
+                for at, value in other.points.items():
+                    if at in points and points[at] == value:
+                        del points[at]
+        try:
+            result = self._write(datapoints_manager, points)
+            batch.written = True
+            return result
+        finally:
+            with self._lock:
+                pending.pop(key, None)
+                if not pending:
+                    self._pending.pop(stream, None)
+            batch.done.set()
+
+    def _sharing(self, stream, points):
+        """Returns a batch in flight holding some of the points, or None."""
+        for batch in self._pending.get(stream, {}).values():
+            for at, value in batch.points.items():
+                if at in points and points[at] == value:
+                    return batch
+        return None
+
+    def _key(self, stream, points):
+        digest = hashlib.sha1()
+        for at, value in sorted(points.items()):
+            digest.update('{}={};'.format(at.isoformat(), value)
+                          .encode('utf8'))
+        return (stream, min(points), max(points), digest.hexdigest())
+
+    def _write(self, datapoints_manager, points):
+        datapoints = [{'at': at, 'value': value}
+                      for at, value in points.items()]
+        try:
+            return datapoints_manager.create(datapoints)
+        except (ConnectionError, Timeout, HTTPError) as e:
+            if not self._is_ambiguous(e):
+                raise
+            error = e
+        with self._lock:
+            self.stats['ambiguous'] += 1
+        for _ in range(self.verify_retries):
+            try:
+                missing = self._missing(datapoints_manager, points)
+                if missing:
+                    datapoints_manager.create(missing)
+            except (ConnectionError, Timeout, HTTPError) as e:
+                if not self._is_ambiguous(e):
+                    raise
+                error = e
+                continue
+            if missing:
+                with self._lock:
+                    self.stats['resent'] += len(missing)
+            return [datapoints_manager._coerce_to_datapoint(d)
+                    for d in datapoints]
+        raise error
+
+    def _is_ambiguous(self, error):
+        if isinstance(error, HTTPError):
+            response = error.response
+            return (response is not None and
+                    response.status_code in self.AMBIGUOUS_STATUS_CODES)
+        return True
+
+    def _missing(self, datapoints_manager, points):
+        """Returns the datapoints Cosm doesn't hold, as dicts."""
+        stored = dict(
+            (d.at, d.value) for d in datapoints_manager.history(
+                start=min(points), end=max(points), interval=0,
+                limit=len(points)))
+        return [{'at': at, 'value': value}
+                for at, value in points.items()
+                if at not in stored or str(stored[at]) != str(value)]
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive polling of many feeds through the REST API.
+
+Each watched feed is kept in a priority queue ordered by when it is next due.
+Feeds whose datastreams change are polled more often, quiet feeds back off
+towards `max_interval`.  Feeds which fall due together are fetched with a
+single list request and the overall request rate can be capped.
+
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from cosm.utils import RateLimiter
+
+
+log = logging.getLogger(__name__)
+
+
+class _Watch(object):
+
+    def __init__(self, feed_id, datastreams, interval):
+        self.feed_id = feed_id
+        self.datastreams = datastreams
+        self.interval = interval
+        self.values = {}
+
+
+class Poller(object):
+    """Polls feeds and reports datastreams whose value or time changed.
+
+    `callback` is called with the feed id and the changed Datastream.
+
+    """
+
+    def __init__(self, api, callback=None, interval=60.0, min_interval=5.0,
+                 max_interval=3600.0, backoff=1.5, batch_size=50,
+                 max_rate=None, clock=time.time, sleep=time.sleep):
+        self.feeds = api.feeds
+        self.callback = callback
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.clock = clock
+        self.sleep = sleep
+        self.limiter = None
+        if max_rate:
+            self.limiter = RateLimiter(max_rate, clock=clock, sleep=sleep)
+        self.requests = 0
+        self._watches = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._stopped = threading.Event()
+        self._condition = threading.Condition()
+
+    def watch(self, feed_id, datastreams=None):
+        """Starts polling a feed, optionally only some of its datastreams."""
+        watch = _Watch(feed_id, datastreams, self.interval)
+        with self._condition:
+            self._watches[feed_id] = watch
+            entry = (self.clock(), next(self._counter), watch)
+            heapq.heappush(self._queue, entry)
+            self._condition.notify_all()
+
+    def unwatch(self, feed_id):
+        with self._condition:
+            self._watches.pop(feed_id, None)
+
+    def interval_for(self, feed_id):
+        return self._watches[feed_id].interval
+
+    def run(self):
+        """Polls due feeds until `stop` is called."""
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            with self._condition:
+                delay = self._next_due() - self.clock()
+                if delay > 0:
+                    # Woken early by watch and stop.
+                    self._condition.wait(min(delay, self.max_interval))
+                    continue
+            try:
+                self.poll()
+            except Exception:
+                log.exception("Polling feeds failed")
+
+    def stop(self):
+        with self._condition:
+            self._stopped.set()
+            self._condition.notify_all()
+
+    def poll(self):
+        """Fetches every feed that is due and returns the changes found.
+
+        If a fetch fails its feeds back off as if unchanged, the feeds not
+        fetched yet are scheduled again, the changes found so far are
+        reported and the error is raised.
+
+        """
+        with self._condition:
+            due = self._pop_due(self.clock())
+        changes = []
+        done = 0
+        try:
+            for start in range(0, len(due), self.batch_size):
+                batch = due[start:start + self.batch_size]
+                try:
+                    feeds = self._fetch(batch)
+                except Exception:
+                    for watch in batch:
+                        self._adapt(watch, False)
+                    raise
+                now = self.clock()
+                for watch in batch:
+                    feed = feeds.get(watch.feed_id)
+                    first = not watch.values
+                    changed = self._changed(watch, feed) if feed else []
+                    if not first:
+                        self._adapt(watch, bool(changed))
+                    with self._condition:
+                        self._schedule(watch, now)
+                    changes.extend((watch.feed_id, d) for d in changed)
+                done = start + len(batch)
+        finally:
+            now = self.clock()
+            with self._condition:
+                for watch in due[done:]:
+                    self._schedule(watch, now)
+            # The values of changed datastreams are already stored, so
+            # changes not reported now never would be.
+            if self.callback is not None:
+                for feed_id, datastream in changes:
+                    self.callback(feed_id, datastream)
+        return changes
+
+    def _fetch(self, batch):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        self.requests += 1
+        if len(batch) == 1:
+            (watch,) = batch
+            params = {}
+            if watch.datastreams:
+                params['datastreams'] = ','.join(watch.datastreams)
+            feed = self.feeds.get(watch.feed_id, **params)
+            return {watch.feed_id: feed}
+        ids = ','.join(str(watch.feed_id) for watch in batch)
+        feeds = self.feeds.list(ids=ids, per_page=len(batch))
+        return dict((feed.id, feed) for feed in feeds)
+
+    def _changed(self, watch, feed):
+        changed = []
+        for datastream in feed._data.get('datastreams', []):
+            if watch.datastreams and datastream.id not in watch.datastreams:
+                continue
+            value = (datastream._data.get('current_value'),
+                     datastream._data.get('at'))
+            if watch.values.get(datastream.id) != value:
+                watch.values[datastream.id] = value
+                changed.append(datastream)
+        return changed
+
+    def _adapt(self, watch, changed):
+        if changed:
+            interval = watch.interval / self.backoff
+        else:
+            interval = watch.interval * self.backoff
+        watch.interval = max(self.min_interval,
+                             min(self.max_interval, interval))
+
+    def _schedule(self, watch, now):
+        entry = (now + watch.interval, next(self._counter), watch)
+        heapq.heappush(self._queue, entry)
+
+    def _next_due(self):
+        while self._queue:
+            due, _, watch = self._queue[0]
+            if self._watches.get(watch.feed_id) is watch:
+                return due
+            heapq.heappop(self._queue)
+        return self.clock() + self.max_interval
+
+    def _pop_due(self, now):
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            _, _, watch = heapq.heappop(self._queue)
+            if self._watches.get(watch.feed_id) is watch:
+                due.append(watch)
+        return due
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+Spreading requests over several API keys.
+
+A `ClientPool` behaves like `cosm.api.Client` but holds one `cosm.Client`
+per API key.  Requests concerning a feed are sent with the key owning that
+feed, read-only requests for feeds without a known owner are spread over all
+keys so that their rate limits add up.
+
+    pool = ClientPool(["KEY1", "KEY2"], owners={504: "KEY2"})
+    feed = pool.feeds.get(504)
+
+"""
+
+import functools
+import itertools
+import re
+import threading
+import time
+
+import cosm
+import cosm.api
+
+from cosm.scheduler import current_priority
+
+
+FEED_URL = re.compile(r'/feeds/(\d+)')
+
+
+class Router(object):
+    """Routes requests to the `cosm.Client` of one of several keys.
+
+    Owners of feeds may be given as a {feed_id: key} mapping and are learned
+    from created feeds and from requests which only succeeded with one key.
+    Keys answering 429 Too Many Requests are rested for `Retry-After` (or
+    `throttle_delay`) seconds while other keys take their share.
+
+    """
+    client_class = cosm.Client
+
+    def __init__(self, keys, owners=None, throttle_delay=60, clock=time.time,
+                 **kwargs):
+        self.clients = [self.client_class(key, **kwargs) for key in keys]
+        self.owners = dict((str(feed_id), self._client_for_key(key))
+                           for feed_id, key in (owners or {}).items())
+        self.throttle_delay = throttle_delay
+        self.clock = clock
+        self.datapoint_hooks = []
+        self.write_behind = None
+        self.scheduler = None
+        self.resilience = None
+        self.stats = dict((client.auth.key, {'requests': 0, 'throttled': 0})
+                          for client in self.clients)
+        self._throttled = {}
+        self._cycle = itertools.cycle(range(len(self.clients)))
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return self.clients[0].base_url
+
+    @base_url.setter  # NOQA
+    def base_url(self, base_url):
+        for client in self.clients:
+            client.base_url = base_url
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        send = self._route
+        priority = kwargs.pop('priority', None)
+        if self.scheduler is not None:
+            send = functools.partial(self.scheduler.call,
+                                     priority or current_priority(),
+                                     self._route)
+        if self.resilience is not None:
+            return self.resilience.call(method, url, send, **kwargs)
+        return send(method, url, **kwargs)
+
+    def _route(self, method, url, **kwargs):
+        match = FEED_URL.search(url)
+        feed_id = match.group(1) if match else None
+        with self._lock:
+            owner = self.owners.get(feed_id)
+        if owner is not None:
+            return self._send(owner, method, url, kwargs)
+        if method == 'GET':
+            candidates = self._spread()
+        else:
+            candidates = list(self.clients)
+        refused = False
+        for client in candidates:
+            response = self._send(client, method, url, kwargs)
+            if response.status_code not in (401, 403, 404, 429):
+                break
+            # Throttling says nothing about which key may see the feed.
+            refused = refused or response.status_code != 429
+        if response.status_code < 400:
+            if feed_id is None and method == 'POST':
+                location = response.headers.get('location') or ''
+                match = FEED_URL.search(location)
+                feed_id = match.group(1) if match else None
+            if feed_id is not None and (method != 'GET' or refused):
+                with self._lock:
+                    self.owners[feed_id] = client
+        return response
+
+    def _send(self, client, method, url, kwargs):
+        response = client.request(method, url, **kwargs)
+        stats = self.stats[client.auth.key]
+        with self._lock:
+            stats['requests'] += 1
+            if response.status_code == 429:
+                stats['throttled'] += 1
+                delay = response.headers.get('Retry-After')
+                delay = float(delay) if delay else self.throttle_delay
+                self._throttled[client] = self.clock() + delay
+        return response
+
+    def _spread(self):
+        """Returns all clients, starting with the next unthrottled one."""
+        now = self.clock()
+        with self._lock:
+            start = next(self._cycle)
+            ordered = self.clients[start:] + self.clients[:start]
+            return sorted(ordered,
+                          key=lambda c: max(self._throttled.get(c, 0), now))
+
+    def _client_for_key(self, key):
+        for client in self.clients:
+            if client.auth.key == key:
+                return client
+        raise ValueError("Unknown key {!r}".format(key))
+
+
+class ClientPool(cosm.api.Client):
+    """A Cosm API client sharing its work between several API keys."""
+
+    client_class = Router
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hedged reads and circuit breakers per endpoint.
+
+A `Resilience` attached to an API client sends a second copy of a GET which
+hasn't been answered within the usual latency of its endpoint and returns
+whichever answers first.  It also stops sending requests to an endpoint
+whose requests mostly fail, raising `CircuitOpen` instead until the endpoint
+has had time to recover:
+
+    resilience = Resilience(cooldown=30, datapoints={'hedge': False})
+    resilience.attach(client)
+    feed = client.feeds.get(504)
+    resilience.metrics()['feeds']['hedge_wins']
+
+Endpoints are the kinds of resources the managers handle: `feeds`,
+`datastreams`, `datapoints` and `triggers`.
+
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+try:
+    from Queue import Queue, Empty
+    from urlparse import urlparse
+except ImportError:
+    from queue import Queue, Empty  # NOQA
+    from urllib.parse import urlparse  # NOQA
+
+from requests.exceptions import RequestException
+
+from cosm.scheduler import _percentile
+
+
+ENDPOINTS = ('feeds', 'datastreams', 'datapoints', 'triggers')
+
+#: Methods which may safely be sent twice.
+IDEMPOTENT = ('GET', 'HEAD')
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpen(RequestException):
+    """Raised instead of sending a request to an endpoint that is failing."""
+
+
+def endpoint(url):
+    """Returns the kind of resource a url refers to, or None.
+
+    >>> endpoint('feeds/504/datastreams/energy')
+    'datastreams'
+    >>> endpoint('http://api.cosm.com/v2/feeds/504.json')
+    'feeds'
+
+    """
+    segments = urlparse(url).path.split('/')
+    for segment in reversed(segments):
+        if segment in ENDPOINTS:
+            return segment
+    return None
+
+
+class _Endpoint(object):
+    """The settings, latencies and circuit of one endpoint."""
+
+    def __init__(self, hedge, hedge_percentile, min_hedge_delay,
+                 failure_rate, min_requests, cooldown, window):
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.state = CLOSED
+        self.opened = None
+        self.stats = dict.fromkeys(
+            ['requests', 'errors', 'hedged', 'hedge_wins', 'hedge_skipped',
+             'rejected', 'opened'], 0)
+
+    def hedge_delay(self):
+        """Returns how long to wait before hedging, None if not hedging."""
+        if not self.hedge or len(self.latencies) < self.min_requests:
+            return None
+        latencies = sorted(self.latencies)
+        return max(_percentile(latencies, self.hedge_percentile),
+                   self.min_hedge_delay)
+
+    def admit(self, now):
+        """Returns whether a request may be sent, for a half-open circuit
+        letting a single trial request through."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now - self.opened >= self.cooldown:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def record(self, failed, now):
+        self.outcomes.append(failed)
+        if self.state == HALF_OPEN:
+            if failed:
+                self._open(now)
+            else:
+                self.state = CLOSED
+                self.outcomes.clear()
+        elif (self.state == CLOSED and
+              len(self.outcomes) >= self.min_requests and
+              sum(self.outcomes) >= self.failure_rate * len(self.outcomes)):
+            self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened = now
+        self.stats['opened'] += 1
+
+
+class _Workers(object):
+    """Daemon threads sending the attempts of hedged requests.
+
+    A thread is started whenever none is idle, so attempts never wait for
+    one another.  Idle threads are kept for later requests and end after
+    `idle_timeout` seconds without work.
+
+    """
+
+    def __init__(self, idle_timeout=60.0):
+        self.idle_timeout = idle_timeout
+        self._threads = set()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._idle:
+                self._idle.pop().put((func, args))
+                return
+            thread = threading.Thread(target=self._run, args=(func, args))
+            thread.daemon = True
+            self._threads.add(thread)
+        thread.start()
+
+    def _run(self, func, args):
+        tasks = Queue()
+        while True:
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Hedged request attempt failed")
+            with self._lock:
+                self._idle.append(tasks)
+            try:
+                func, args = tasks.get(timeout=self.idle_timeout)
+            except Empty:
+                with self._lock:
+                    if tasks in self._idle:
+                        self._idle.remove(tasks)
+                        self._threads.discard(threading.current_thread())
+                        return
+                # A task was handed over while timing out.
+                func, args = tasks.get()
+
+
+class Resilience(object):
+    """Hedges GETs and breaks circuits, per endpoint.
+
+    A GET which hasn't been answered after the `hedge_percentile` latency of
+    the recent successful requests to its endpoint (but at least
+    `min_hedge_delay` seconds) is sent again, and the first answer is
+    returned.  Hedging starts once `min_requests` latencies are known.
+
+    The circuit of an endpoint opens when at least `failure_rate` of its
+    last requests failed (raised, or answered with a 5xx status).  Requests
+    then raise `CircuitOpen` until `cooldown` seconds passed, after which a
+    single trial request decides whether the circuit closes again.
+
+    Hedged GETs are sent from a pool of threads which grows as needed, and
+    the answer which loses is closed.  At most `max_hedges` copies are in
+    flight at once; a GET which is late beyond that isn't hedged, so an
+    overloaded endpoint doesn't get even more requests.
+
+    Keyword arguments named after endpoints override these settings for
+    that endpoint, e.g. `datapoints={'hedge': False}`.
+
+    """
+
+    def __init__(self, hedge=True, hedge_percentile=0.95,
+                 min_hedge_delay=0.005, failure_rate=0.5, min_requests=20,
+                 cooldown=30.0, window=100, max_hedges=8, clock=time.time,
+                 **endpoints):
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise ValueError("Unknown endpoints {}".format(sorted(unknown)))
+        defaults = dict(hedge=hedge, hedge_percentile=hedge_percentile,
+                        min_hedge_delay=min_hedge_delay,
+                        failure_rate=failure_rate, min_requests=min_requests,
+                        cooldown=cooldown, window=window)
+        self.clock = clock
+        self._endpoints = {}
+        for name in ENDPOINTS + (None,):
+            settings = dict(defaults, **endpoints.get(name, {}))
+            self._endpoints[name] = _Endpoint(**settings)
+        self.max_hedges = max_hedges
+        self._hedges = 0
+        self._workers = _Workers()
+        self._lock = threading.Lock()
+
+    def attach(self, api):
+        """Protects the requests of an API client."""
+        api.client.resilience = self
+
+    def call(self, method, url, send, *args, **kwargs):
+        """Sends a request with send(method, url, *args, **kwargs)."""
+        state = self._endpoints[endpoint(url)]
+        with self._lock:
+            if not state.admit(self.clock()):
+                state.stats['rejected'] += 1
+                raise CircuitOpen("Circuit for {} is open".format(url))
+            state.stats['requests'] += 1
+            delay = None
+            if method.upper() in IDEMPOTENT and not kwargs.get('stream'):
+                delay = state.hedge_delay()
+        started = self.clock()
+        failed = True
+        try:
+            if delay is None:
+                response = send(method, url, *args, **kwargs)
+            else:
+                response = self._hedge(state, delay, send, method, url,
+                                       args, kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            latency = self.clock() - started
+            with self._lock:
+                state.stats['errors'] += failed
+                if not failed:
+                    state.latencies.append(latency)
+                state.record(failed, self.clock())
+
+    def _hedge(self, state, delay, send, method, url, args, kwargs):
+        """Returns the first answer of the request and, once it is late, of
+        its copy.  If both fail the first error is raised."""
+        answers = Queue()
+        decided = threading.Event()
+        lock = threading.Lock()
+
+        def attempt(hedge):
+            try:
+                answer = (hedge, send(method, url, *args, **kwargs), None)
+            except Exception as e:
+                answer = (hedge, None, e)
+            finally:
+                if hedge:
+                    with self._lock:
+                        self._hedges -= 1
+            with lock:
+                if not decided.is_set():
+                    answers.put(answer)
+                    return
+            if answer[1] is not None:
+                answer[1].close()
+
+        self._workers.submit(attempt, False)
+        try:
+            answer = answers.get(timeout=delay)
+        except Empty:
+            with self._lock:
+                hedge = self._hedges < self.max_hedges
+                if hedge:
+                    self._hedges += 1
+                    state.stats['hedged'] += 1
+                else:
+                    state.stats['hedge_skipped'] += 1
+            if not hedge:
+                answer = answers.get()
+                if answer[2] is not None:
+                    raise answer[2]
+                return answer[1]
+            self._workers.submit(attempt, True)
+            answer = answers.get()
+            if answer[2] is not None:
+                error = answer[2]
+                answer = answers.get()
+                if answer[2] is not None:
+                    raise error
+            if answer[0]:
+                with self._lock:
+                    state.stats['hedge_wins'] += 1
+            with lock:
+                decided.set()
+            while not answers.empty():
+                late = answers.get()
+                if late[1] is not None:
+                    late[1].close()
+        if answer[2] is not None:
+            raise answer[2]
+        return answer[1]
+
+    def metrics(self):
+        """Returns the counters, circuit state and hedge delay of each
+        endpoint."""
+        metrics = {}
+        with self._lock:
+            for name in ENDPOINTS:
+                state = self._endpoints[name]
+                metrics[name] = dict(state.stats, state=state.state,
+                                     hedge_delay=state.hedge_delay())
+        return metrics
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rolling datapoints up into derived datastreams as they are written.
+
+A `RollupEngine` attached to an API client aggregates the datapoints created
+through it into fixed periods and writes the min, max, mean, sum or count of
+each finished period to datastreams of the same feed:
+
+    engine = RollupEngine(watermark=120)
+    engine.add(temperature, 60, min='temperature_min_1m',
+               max='temperature_max_1m', mean='temperature_mean_1m')
+    engine.add(temperature, 3600, mean='temperature_mean_1h',
+               count='temperature_count_1h')
+    engine.attach(client)
+    temperature.datapoints.create(readings)
+    engine.close()
+
+"""
+
+import logging
+import threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import cosm
+
+
+EPOCH = datetime(1970, 1, 1)
+
+AGGREGATES = ('min', 'max', 'mean', 'sum', 'count')
+
+log = logging.getLogger(__name__)
+
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class _Rollup(object):
+    """The open periods of one rollup of a datastream."""
+
+    def __init__(self, datastreams_manager, period, targets):
+        self.datastreams_manager = datastreams_manager
+        self.period = timedelta(seconds=period)
+        self.targets = targets
+        self.buckets = {}
+        self.newest = None
+        self.finished = None
+
+    def bucket(self, at):
+        """Returns the start of the period at falls into."""
+        offset = _microseconds(at - EPOCH) % _microseconds(self.period)
+        return at - timedelta(microseconds=offset)
+
+    def add(self, at, value):
+        """Adds a value to its period, returning False if that is finished."""
+        start = self.bucket(at)
+        if self.finished is not None and start < self.finished:
+            return False
+        bucket = self.buckets.get(start)
+        if bucket is None:
+            self.buckets[start] = [value, value, value, 1]
+        else:
+            bucket[0] = min(bucket[0], value)
+            bucket[1] = max(bucket[1], value)
+            bucket[2] += value
+            bucket[3] += 1
+        if self.newest is None or at > self.newest:
+            self.newest = at
+        return True
+
+    def finish(self, until):
+        """Removes and returns the periods ended by until, oldest first.
+
+        Periods are returned as (start, aggregates) pairs.
+
+        """
+        boundary = self.bucket(until)
+        if self.finished is not None and boundary <= self.finished:
+            return []
+        self.finished = boundary
+        finished = []
+        for start in sorted(self.buckets):
+            if start >= boundary:
+                break
+            minimum, maximum, total, count = self.buckets.pop(start)
+            finished.append((start, {
+                'min': minimum, 'max': maximum, 'mean': total / count,
+                'sum': total, 'count': count,
+            }))
+        return finished
+
+
+class RollupEngine(object):
+    """Aggregates the datapoints written through a client by period.
+
+    A period is finished once a datapoint `watermark` seconds past its end
+    has been seen (or `advance` is called with a later time).  Datapoints
+    arriving for a finished period are dropped and counted as late.  Only
+    the periods within the watermark are held, so memory doesn't grow with
+    the number of datapoints.  Finished periods are written once
+    `batch_size` derived datapoints are pending, and on `flush`.  A failed
+    write while recording is logged and its datapoints stay pending until
+    the next flush, so it never fails the write being recorded.
+
+    The engine's own writes to derived datastreams are not rolled up.
+
+    """
+
+    def __init__(self, watermark=60, batch_size=100):
+        self.watermark = timedelta(seconds=watermark)
+        self.batch_size = batch_size
+        self.stats = dict.fromkeys(
+            ['datapoints', 'late', 'invalid', 'written'], 0)
+        self._rollups = {}
+        self._pending = OrderedDict()
+        self._pending_count = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add(self, datastream, period, **targets):
+        """Rolls up a datastream by `period` seconds.
+
+        `targets` map aggregates (min, max, mean, sum, count) to the ids of
+        the datastreams of the same feed receiving them.
+
+        """
+        unknown = set(targets) - set(AGGREGATES)
+        if unknown:
+            raise ValueError("Unknown aggregates {}".format(sorted(unknown)))
+        rollup = _Rollup(datastream._manager, period, targets)
+        with self._lock:
+            self._rollups.setdefault(
+                datastream.datapoints.history_url, []).append(rollup)
+
+    def attach(self, api):
+        """Rolls up the datapoints created through an API client."""
+        api.client.datapoint_hooks.append(self.record)
+
+    def record(self, datapoints_manager, datapoints):
+        if getattr(self._local, 'writing', False):
+            return
+        rollups = self._rollups.get(datapoints_manager.history_url)
+        if not rollups:
+            return
+        with self._lock:
+            for datapoint in datapoints:
+                try:
+                    value = float(datapoint.value)
+                except (TypeError, ValueError):
+                    self.stats['invalid'] += 1
+                    continue
+                self.stats['datapoints'] += 1
+                for rollup in rollups:
+                    if not rollup.add(datapoint.at, value):
+                        self.stats['late'] += 1
+            for rollup in rollups:
+                if rollup.newest is not None:
+                    self._emit(rollup, rollup.newest - self.watermark)
+            full = self._pending_count >= self.batch_size
+        if full:
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Writing rollups failed, keeping them pending")
+
+    def advance(self, now=None):
+        """Finishes the periods ended by now minus the watermark.
+
+        This also finishes the periods of datastreams which stopped
+        receiving datapoints.
+
+        """
+        now = now or datetime.utcnow()
+        with self._lock:
+            for rollups in self._rollups.values():
+                for rollup in rollups:
+                    self._emit(rollup, now - self.watermark)
+        self.flush()
+
+    def flush(self):
+        """Writes the finished periods to the derived datastreams."""
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            self._pending_count = 0
+        items = list(pending.items())
+        self._local.writing = True
+        try:
+            for i, ((_, target), (manager, points)) in enumerate(items):
+                datastream = cosm.Datastream(id=target)
+                datastream._manager = manager
+                try:
+                    datastream.datapoints.create(points)
+                except Exception:
+                    self._restore(items[i:])
+                    raise
+                with self._lock:
+                    self.stats['written'] += len(points)
+        finally:
+            self._local.writing = False
+
+    def _restore(self, items):
+        """Puts back the derived datapoints a flush failed to write."""
+        with self._lock:
+            for key, (manager, points) in items:
+                newer = self._pending.get(key)
+                if newer is not None:
+                    points.extend(newer[1])
+                    self._pending_count -= len(newer[1])
+                self._pending[key] = (manager, points)
+                self._pending_count += len(points)
+
+    def close(self):
+        """Finishes and writes every open period."""
+        with self._lock:
+            for rollups in self._rollups.values():
+                for rollup in rollups:
+                    if rollup.buckets:
+                        newest = max(rollup.buckets)
+                        self._emit(rollup, newest + rollup.period)
+        self.flush()
+
+    def _emit(self, rollup, until):
+        manager = rollup.datastreams_manager
+        for start, aggregates in rollup.finish(until):
+            for aggregate, target in rollup.targets.items():
+                _, points = self._pending.setdefault(
+                    (manager.base_url, target), (manager, []))
+                points.append({'at': start, 'value': aggregates[aggregate]})
+                self._pending_count += 1
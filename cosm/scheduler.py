@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Priority classes for requests sharing one client.
+
+Requests are either `INTERACTIVE` (the default) or `BULK`.  A `Scheduler`
+attached to an API client keeps some of the concurrent request slots and of
+the request rate for interactive requests, so that a backfill can't hold up
+a dashboard:
+
+    scheduler = Scheduler(slots=10, reserved_slots=2, rate=50)
+    scheduler.attach(client)
+    with priority(BULK):
+        datapoints = datastream.datapoints.history(start=start, end=end)
+    client.client.get(url, priority=INTERACTIVE)
+
+"""
+
+import contextlib
+import threading
+import time
+
+from collections import deque
+
+from cosm.utils import RateLimiter
+
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+PRIORITIES = (INTERACTIVE, BULK)
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def priority(name):
+    """Sends the requests of the calling thread with the given priority."""
+    if name not in PRIORITIES:
+        raise ValueError("Unknown priority {!r}".format(name))
+    previous = getattr(_local, 'priority', None)
+    _local.priority = name
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    """Returns the priority of the calling thread's requests."""
+    return getattr(_local, 'priority', None) or INTERACTIVE
+
+
+class Scheduler(object):
+    """Admits requests by priority class.
+
+    At most `slots` requests run at once, and bulk requests never take the
+    last `reserved_slots` of them nor start while interactive requests are
+    waiting.  Set `slots` to the size of the connection pool (10 by default
+    for requests) so that slots stand for connections.
+
+    With a `rate`, requests are limited to that many per second, of which
+    bulk requests may only use `1 - reserved_rate`.
+
+    """
+
+    def __init__(self, slots=10, reserved_slots=2, rate=None,
+                 reserved_rate=0.2, clock=time.time, sleep=time.sleep,
+                 window=1000):
+        if not 0 <= reserved_slots < slots:
+            raise ValueError("reserved_slots must be less than slots")
+        self.slots = slots
+        self.reserved_slots = reserved_slots
+        self.clock = clock
+        self._limiters = {INTERACTIVE: [], BULK: []}
+        if rate:
+            shared = RateLimiter(rate, clock=clock, sleep=sleep)
+            bulk = RateLimiter(rate * (1 - reserved_rate), clock=clock,
+                               sleep=sleep)
+            self._limiters = {INTERACTIVE: [shared], BULK: [bulk, shared]}
+        self._active = dict.fromkeys(PRIORITIES, 0)
+        self._waiting = dict.fromkeys(PRIORITIES, 0)
+        self._stats = dict(
+            (name, {'requests': 0, 'errors': 0, 'wait_total': 0.0,
+                    'latency_total': 0.0, 'latencies': deque(maxlen=window)})
+            for name in PRIORITIES)
+        self._condition = threading.Condition()
+
+    def attach(self, api):
+        """Schedules the requests of an API client."""
+        api.client.scheduler = self
+
+    def call(self, priority, func, *args, **kwargs):
+        """Calls func once the priority class may send a request."""
+        priority = priority or current_priority()
+        if priority not in PRIORITIES:
+            raise ValueError("Unknown priority {!r}".format(priority))
+        queued = self.clock()
+        for limiter in self._limiters[priority]:
+            limiter.acquire()
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while not self._may_start(priority):
+                    self._condition.wait()
+            finally:
+                self._waiting[priority] -= 1
+            self._active[priority] += 1
+        started = self.clock()
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            finished = self.clock()
+            with self._condition:
+                self._active[priority] -= 1
+                self._condition.notify_all()
+                stats = self._stats[priority]
+                stats['requests'] += 1
+                stats['errors'] += failed
+                stats['wait_total'] += started - queued
+                stats['latency_total'] += finished - queued
+                stats['latencies'].append(finished - queued)
+
+    def _may_start(self, priority):
+        active = sum(self._active.values())
+        if priority == INTERACTIVE:
+            return active < self.slots
+        return (active < self.slots - self.reserved_slots and
+                not self._waiting[INTERACTIVE])
+
+    def metrics(self):
+        """Returns per class counters and latencies in seconds.
+
+        Latencies include the time spent waiting for a slot; percentiles and
+        the maximum are those of the most recent requests.
+
+        """
+        metrics = {}
+        with self._condition:
+            for name, stats in self._stats.items():
+                latencies = sorted(stats['latencies'])
+                count = stats['requests']
+                metrics[name] = {
+                    'requests': count,
+                    'errors': stats['errors'],
+                    'active': self._active[name],
+                    'waiting': self._waiting[name],
+                    'wait_mean': stats['wait_total'] / count if count else 0.0,
+                    'latency_mean': (stats['latency_total'] / count
+                                     if count else 0.0),
+                    'latency_p50': _percentile(latencies, 0.5),
+                    'latency_p95': _percentile(latencies, 0.95),
+                    'latency_max': latencies[-1] if latencies else 0.0,
+                }
+        return metrics
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
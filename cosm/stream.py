@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+A client for the Cosm streaming (socket) interface.
+
+Rather than polling the REST API for changes the socket server pushes
+updates to subscribed feeds and datastreams over one long lived connection.
+Messages are newline delimited JSON objects:
+
+    {"method": "subscribe", "resource": "/feeds/504",
+     "headers": {"X-ApiKey": "..."}, "token": "..."}
+
+"""
+
+import json
+import logging
+import socket
+import threading
+import uuid
+
+from datetime import datetime
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty  # NOQA
+
+import cosm
+
+
+log = logging.getLogger(__name__)
+
+
+def _parse_datetime(value):
+    if '.' in value:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+
+
+class Subscription(object):
+    """A subscription to a feed or a single datastream of a feed."""
+
+    def __init__(self, feed_id, datastream_id=None, callback=None):
+        self.feed_id = feed_id
+        self.datastream_id = datastream_id
+        self.callback = callback
+        self.token = uuid.uuid4().hex
+        self.status = None
+
+    @property
+    def resource(self):
+        resource = '/feeds/{}'.format(self.feed_id)
+        if self.datastream_id is not None:
+            resource += '/datastreams/{}'.format(self.datastream_id)
+        return resource
+
+    def __repr__(self):
+        return "<Subscription {}>".format(self.resource)
+
+
+class Client(object):
+    """A Cosm streaming client.
+
+    All subscriptions are multiplexed over a single socket which is read by a
+    background thread.  If the connection drops it is re-established and
+    every subscription is sent again.  Updates are delivered as Feed or
+    Datastream objects, either to the callback given when subscribing or
+    through the `updates` iterator.
+
+    """
+    HOST = 'api.cosm.com'
+    PORT = 8081
+
+    def __init__(self, key, host=None, port=None, reconnect_delay=1.0,
+                 max_reconnect_delay=60.0, timeout=None):
+        self.key = key
+        self.host = host or self.HOST
+        self.port = port or self.PORT
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.timeout = timeout
+        self.connections = 0
+        self._subscriptions = {}
+        self._updates = Queue()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """Starts the background thread which maintains the connection."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """Closes the connection and stops the `updates` iterator."""
+        self._closed.set()
+        self._disconnect()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._updates.put(None)
+
+    def subscribe(self, feed_id, datastream_id=None, callback=None):
+        """Subscribes to a feed, or a datastream if one is given.
+
+        The callback is called from the reader thread with the subscription
+        and the updated Feed or Datastream.  Without a callback updates are
+        queued for the `updates` iterator.
+
+        """
+        subscription = Subscription(feed_id, datastream_id, callback)
+        with self._lock:
+            self._subscriptions[subscription.token] = subscription
+            if self._sock is not None:
+                self._send('subscribe', subscription)
+        self.connect()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.pop(subscription.token, None)
+            if self._sock is not None:
+                self._send('unsubscribe', subscription)
+
+    def updates(self, timeout=None):
+        """Yields (subscription, update) pairs as they arrive.
+
+        Stops once the client is closed or when no update arrived within
+        `timeout` seconds.
+
+        """
+        while True:
+            try:
+                item = self._updates.get(timeout=timeout)
+            except Empty:
+                return
+            if item is None:
+                return
+            yield item
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._closed.is_set():
+            try:
+                self._connect()
+                delay = self.reconnect_delay
+                self._read()
+            except (socket.error, IOError):
+                pass
+            self._disconnect()
+            self._closed.wait(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        with self._lock:
+            if self._closed.is_set():
+                sock.close()
+                return
+            self._sock = sock
+            self.connections += 1
+            for subscription in list(self._subscriptions.values()):
+                self._send('subscribe', subscription)
+
+    def _disconnect(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def _send(self, method, subscription):
+        message = {
+            'method': method,
+            'resource': subscription.resource,
+            'headers': {'X-ApiKey': self.key},
+            'token': subscription.token,
+        }
+        self._sock.sendall(json.dumps(message).encode('utf8') + b'\n')
+
+    def _read(self):
+        sock = self._sock
+        if sock is None:
+            return
+        reader = sock.makefile('rb')
+        try:
+            for line in reader:
+                line = line.strip()
+                if line:
+                    self._handle(line)
+        finally:
+            reader.close()
+
+    def _handle(self, line):
+        try:
+            message = json.loads(line.decode('utf8'))
+        except ValueError:
+            return
+        subscription = self._subscriptions.get(message.get('token'))
+        if subscription is None:
+            return
+        if 'status' in message:
+            subscription.status = message['status']
+        if 'body' not in message:
+            return
+        # A bad update or a failing callback must not stop the reader thread,
+        # which would leave every other subscription without updates.
+        try:
+            update = self._coerce_update(subscription, message['body'])
+            if subscription.callback is not None:
+                subscription.callback(subscription, update)
+            else:
+                self._updates.put((subscription, update))
+        except Exception:
+            log.exception("Handling an update of %r failed", subscription)
+
+    def _coerce_update(self, subscription, data):
+        if subscription.datastream_id is not None:
+            return self._coerce_to_datastream(data)
+        datastreams_data = data.pop('datastreams', [])
+        feed = cosm.Feed(data.pop('title', None), **data)
+        feed._data['datastreams'] = [
+            self._coerce_to_datastream(d) for d in datastreams_data]
+        return feed
+
+    def _coerce_to_datastream(self, data):
+        """Returns a Datastream with its current value as a Datapoint."""
+        datastream = cosm.Datastream(**data)
+        if 'at' in data and 'current_value' in data:
+            at = _parse_datetime(data['at'])
+            datapoint = cosm.Datapoint(at, data['current_value'])
+            datastream.datapoints = [datapoint]
+        return datastream
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Transports sending the requests of a `cosm.Client`.
+
+By default a `cosm.Client` sends requests through `requests`.  Given a
+transport it only encodes the request, adds its headers and authentication
+and leaves sending it to the transport, which returns a `requests.Response`
+so that callers can't tell the difference:
+
+    client = cosm.api.Client(API_KEY, transport=HTTPTransport())
+    client = cosm.api.Client(API_KEY, transport=HTTP2Transport())
+
+Transports neither follow redirects nor stream responses.
+
+"""
+
+import select
+import socket
+import threading
+import zlib
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib  # NOQA
+
+try:
+    from urllib import urlencode
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlencode, urlsplit  # NOQA
+
+from requests.exceptions import ConnectionError, Timeout
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+
+def build_response(url, status_code, reason, headers, content):
+    """Returns a requests.Response, decompressing the content if needed."""
+    response = Response()
+    response.url = url
+    response.status_code = status_code
+    response.reason = reason
+    response.headers = CaseInsensitiveDict(headers)
+    encoding = response.headers.get('Content-Encoding')
+    if encoding == 'gzip':
+        content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        try:
+            content = zlib.decompress(content)
+        except zlib.error:
+            content = zlib.decompress(content, -zlib.MAX_WBITS)
+    response._content = content
+    return response
+
+
+class HTTPTransport(object):
+    """Sends requests over persistent `http.client` connections.
+
+    Every thread keeps one connection per host, which is reused for all of
+    its requests and reopened once when the server has closed it.  `close`
+    closes the connections of all threads.
+
+    """
+
+    #: Errors of a reused connection the server may have closed meanwhile.
+    STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, socket.error)
+
+    #: Methods which may be sent again if their connection turns out stale
+    #: after the request was written.
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._local = threading.local()
+        self._open = set()
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        query = [parts.query] if parts.query else []
+        if params:
+            query.append(urlencode(params, doseq=True))
+        if query:
+            path += '?' + '&'.join(query)
+        if timeout is None:
+            timeout = self.timeout
+        if data is not None and not isinstance(data, bytes):
+            data = data.encode('utf8')
+        key = (parts.scheme, parts.netloc)
+        connection = self._connections().get(key)
+        if connection is not None and not self._is_open(connection):
+            # Closed by close() from another thread.
+            del self._connections()[key]
+            connection = None
+        if connection is not None and self._closed_by_server(connection):
+            self._drop(key)
+            connection = None
+        try:
+            if connection is not None:
+                # A request that failed to be written can't have been
+                # processed, one that was written is only sent again if
+                # that is safe.
+                written = False
+                try:
+                    self._write(connection, method, path, data, headers,
+                                timeout)
+                    written = True
+                    return self._read(connection, key, url)
+                except socket.timeout:
+                    raise
+                except self.STALE_CONNECTION_ERRORS:
+                    if (written and
+                            method.upper() not in self.IDEMPOTENT_METHODS):
+                        raise
+                    self._drop(key)
+            connection = self._connect(key, parts, timeout)
+            self._write(connection, method, path, data, headers, timeout)
+            return self._read(connection, key, url)
+        except socket.timeout as e:
+            self._drop(key)
+            raise Timeout(e)
+        except (httplib.HTTPException, socket.error) as e:
+            self._drop(key)
+            raise ConnectionError(e)
+
+    def close(self):
+        """Closes the connections of all threads."""
+        with self._lock:
+            connections, self._open = self._open, set()
+        for connection in connections:
+            connection.close()
+
+    def _connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            connections = self._local.connections = {}
+            return connections
+
+    def _connect(self, key, parts, timeout):
+        if parts.scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        connection = connection_class(parts.netloc, timeout=timeout)
+        self._connections()[key] = connection
+        with self._lock:
+            self._open.add(connection)
+        return connection
+
+    def _drop(self, key):
+        connection = self._connections().pop(key, None)
+        if connection is not None:
+            with self._lock:
+                self._open.discard(connection)
+            connection.close()
+
+    def _is_open(self, connection):
+        with self._lock:
+            return connection in self._open
+
+    def _closed_by_server(self, connection):
+        """Returns whether the server has closed an idle connection."""
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (ValueError, socket.error):
+            return True
+        # An idle connection only becomes readable at its end.
+        return bool(readable)
+
+    def _write(self, connection, method, path, data, headers, timeout):
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        else:
+            connection.timeout = timeout
+        connection.request(method, path, body=data, headers=headers or {})
+
+    def _read(self, connection, key, url):
+        raw = connection.getresponse()
+        content = raw.read()
+        if raw.getheader('connection', '').lower() == 'close':
+            self._drop(key)
+        return build_response(url, raw.status, raw.reason,
+                              raw.getheaders(), content)
+
+
+class HTTP2Transport(object):
+    """Sends requests with httpx, multiplexed over HTTP/2 connections.
+
+    Needs httpx installed with HTTP/2 support (`pip install httpx[http2]`).
+    One connection per host is shared by all threads.
+
+    """
+
+    def __init__(self, timeout=None):
+        import httpx
+        self._httpx = httpx
+        self.timeout = timeout
+        self._client = httpx.Client(http2=True, timeout=timeout)
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None):
+        httpx = self._httpx
+        if timeout is None:
+            timeout = self.timeout
+        if data is not None and not isinstance(data, bytes):
+            data = data.encode('utf8')
+        try:
+            raw = self._client.request(method, url, params=params,
+                                       content=data, headers=headers,
+                                       timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise Timeout(e)
+        except httpx.TransportError as e:
+            raise ConnectionError(e)
+        # httpx decodes the content itself.
+        headers = [(name, value) for name, value in raw.headers.items()
+                   if name.lower() != 'content-encoding']
+        return build_response(url, raw.status_code, raw.reason_phrase,
+                              headers, raw.content)
+
+    def close(self):
+        self._client.close()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Receiving trigger notifications.
+
+When a trigger fires Cosm POSTs a form encoded `body` parameter holding a
+JSON description of the trigger, the feed and the triggering datastream to
+the trigger's url.  `Receiver` is a WSGI application accepting these
+notifications and dispatching them to handlers on a pool of worker threads.
+
+    receiver = Receiver([on_trigger], workers=8)
+    wsgiref.simple_server.make_server('', 8000, receiver).serve_forever()
+
+"""
+
+import json
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs  # NOQA
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full  # NOQA
+
+import cosm
+
+
+log = logging.getLogger(__name__)
+
+
+class Receiver(object):
+    """A WSGI application dispatching trigger notifications to handlers.
+
+    Each handler is called with the Trigger and the triggering Datastream.
+    Notifications are queued for the worker threads; once `queue_size`
+    notifications are waiting new ones are answered with 503 so that they
+    are redelivered later.  Redeliveries of a notification that was already
+    accepted are acknowledged but not dispatched again.
+
+    """
+
+    def __init__(self, handlers=None, workers=4, queue_size=1000,
+                 dedup_size=10000):
+        self.handlers = list(handlers or [])
+        self.workers = workers
+        self.dedup_size = dedup_size
+        self._queue = Queue(queue_size)
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._counters = dict.fromkeys([
+            'received', 'accepted', 'duplicates', 'rejected', 'invalid',
+            'processed', 'errors'], 0)
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def close(self):
+        """Waits for queued notifications to be handled, then stops."""
+        self._queue.join()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def metrics(self):
+        """Returns counters, queue depth and handler latency in seconds."""
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics['queue_depth'] = self._queue.qsize()
+            metrics['latency_max'] = self._latency_max
+            metrics['latency_mean'] = 0.0
+            if metrics['processed']:
+                metrics['latency_mean'] = (
+                    self._latency_total / metrics['processed'])
+        return metrics
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'POST':
+            return self._respond(start_response, '405 Method Not Allowed')
+        self._count('received')
+        try:
+            data = self._read_payload(environ)
+            trigger, datastream = self.parse(data)
+        except (KeyError, TypeError, ValueError):
+            self._count('invalid')
+            return self._respond(start_response, '400 Bad Request')
+        key = (trigger.id, data.get('timestamp'))
+        with self._lock:
+            if key in self._seen:
+                self._counters['duplicates'] += 1
+                return self._respond(start_response, '200 OK')
+        self.start()
+        try:
+            self._queue.put_nowait((trigger, datastream))
+        except Full:
+            self._count('rejected')
+            return self._respond(start_response, '503 Service Unavailable',
+                                 [('Retry-After', '1')])
+        with self._lock:
+            self._seen[key] = True
+            while len(self._seen) > self.dedup_size:
+                self._seen.popitem(last=False)
+            self._counters['accepted'] += 1
+        return self._respond(start_response, '200 OK')
+
+    def parse(self, data):
+        """Returns the Trigger and Datastream described by a notification."""
+        environment = data['environment']
+        datastream_data = data['triggering_datastream']
+        trigger = cosm.Trigger(environment['id'], datastream_data['id'],
+                               data['url'], data['type'],
+                               data.get('threshold_value'))
+        trigger._data['id'] = data['id']
+        if 'timestamp' in data:
+            notified_at = self._parse_datetime(data['timestamp'])
+            trigger._data['notified_at'] = notified_at
+        value = datastream_data.get('value', {})
+        datastream = cosm.Datastream(datastream_data['id'])
+        datastream._data.update(
+            (name, value[name]) for name in ('min_value', 'max_value')
+            if name in value)
+        if 'value' in value:
+            datastream._data['current_value'] = value['value']
+        if 'at' in datastream_data:
+            datastream._data['at'] = datastream_data['at']
+            at = self._parse_datetime(datastream_data['at'])
+            datastream.datapoints = [cosm.Datapoint(at, value.get('value'))]
+        return trigger, datastream
+
+    def _parse_datetime(self, value):
+        if '.' in value:
+            return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+
+    def _read_payload(self, environ):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length).decode('utf8')
+        if environ.get('CONTENT_TYPE', '').startswith('application/json'):
+            return json.loads(body)
+        return json.loads(parse_qs(body)['body'][0])
+
+    def _respond(self, start_response, status, headers=()):
+        start_response(status, [('Content-Type', 'text/plain')] +
+                       list(headers))
+        return [status.encode('utf8')]
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._dispatch(*item)
+            finally:
+                self._queue.task_done()
+
+    def _dispatch(self, trigger, datastream):
+        started = time.time()
+        failed = False
+        for handler in self.handlers:
+            try:
+                handler(trigger, datastream)
+            except Exception:
+                log.exception("Trigger handler %r failed", handler)
+                failed = True
+        elapsed = time.time() - started
+        with self._lock:
+            self._counters['processed'] += 1
+            if failed:
+                self._counters['errors'] += 1
+            self._latency_total += elapsed
+            self._latency_max = max(self._latency_max, elapsed)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk import of CSV or NDJSON files into datastreams.
+
+Input is streamed row by row.  Rows either name their feed and datastream in
+`feed` and `datastream` columns, or a wide file maps value columns to
+datastreams with `--map`:
+
+    $ cosm-import --key KEY data.csv.gz
+    $ cosm-import --key KEY --map temp=504:temperature --map rh=504:humidity \\
+          readings.csv
+
+Datapoints are batched per datastream and uploaded by several workers over
+pooled connections.  The line up to which everything has been uploaded is
+checkpointed next to the input file so that an interrupted import resumes.
+
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue  # NOQA
+
+from requests.adapters import HTTPAdapter
+
+import cosm.api
+
+from cosm.export import parse_datetime
+from cosm.utils import RateLimiter
+
+
+#: Most datapoints Cosm accepts in one request.
+BATCH_SIZE = 500
+
+
+def open_input(path):
+    """Opens a text file for reading, decompressing .gz files.
+
+    On Python 2 the csv module reads byte strings, so the file is opened in
+    binary mode there.
+
+    """
+    if sys.version_info < (3,):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')
+        return open(path, 'rb')
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'rb'), newline='')
+    return io.open(path, newline='')
+
+
+def read_records(f, format):
+    """Yields (line number, record dict) pairs of a CSV or NDJSON file."""
+    if format == 'ndjson':
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield number, json.loads(line)
+    else:
+        for number, record in enumerate(csv.DictReader(f), 2):
+            yield number, record
+
+
+def read_rows(records, mapping=None, stream=None, at_column='at',
+              value_column='value'):
+    """Yields (line, feed_id, datastream_id, at, value) rows of records.
+
+    `mapping` maps value columns to (feed_id, datastream_id); otherwise the
+    records' `feed` and `datastream` columns are used, defaulting to
+    `stream`.
+
+    """
+    for number, record in records:
+        at = record[at_column]
+        if not hasattr(at, 'isoformat'):
+            at = parse_datetime(at)
+        if mapping:
+            for column, (feed_id, datastream_id) in mapping.items():
+                value = record.get(column)
+                if value not in (None, ''):
+                    yield number, feed_id, datastream_id, at, value
+        else:
+            feed_id, datastream_id = stream or (None, None)
+            yield (number, int(record.get('feed') or feed_id),
+                   str(record.get('datastream') or datastream_id), at,
+                   record[value_column])
+
+
+class Uploader(object):
+    """Uploads rows of datapoints in batches on worker threads."""
+
+    def __init__(self, api, batch_size=BATCH_SIZE, workers=8, rate=None,
+                 checkpoint=None, log=sys.stderr):
+        self.api = api
+        self.batch_size = batch_size
+        self.workers = workers
+        self.limiter = RateLimiter(rate) if rate else None
+        self.checkpoint = checkpoint
+        self.log = log
+        self.points = 0
+        self.requests = 0
+        self.errors = []
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        api.client.mount('http://', adapter)
+        api.client.mount('https://', adapter)
+        self._feeds = {}
+        self._buffers = {}
+        self._in_flight = {}
+        self._batches = itertools.count()
+        self._queue = Queue(workers * 2)
+        self._lock = threading.Lock()
+
+    def resume_line(self):
+        """Returns the line from which a previous run has to be resumed."""
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                return json.load(f)['line']
+        return 0
+
+    def run(self, rows):
+        """Uploads the rows, returning the number of datapoints uploaded."""
+        threads = [threading.Thread(target=self._work)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        resume = self.resume_line()
+        started = time.time()
+        next_line = resume
+        for line, feed_id, datastream_id, at, value in rows:
+            if line < resume:
+                continue
+            next_line = line + 1
+            key = (feed_id, datastream_id)
+            with self._lock:
+                first_line, datapoints = self._buffers.setdefault(
+                    key, (line, []))
+                datapoints.append({'at': at, 'value': value})
+                full = len(datapoints) >= self.batch_size
+                if full:
+                    del self._buffers[key]
+                    batch = self._register(first_line)
+            if full:
+                self._queue.put((batch, key, datapoints))
+            if self.errors:
+                break
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+            batches = [(self._register(first_line), key, datapoints)
+                       for key, (first_line, datapoints) in buffers.items()]
+        for batch in batches:
+            self._queue.put(batch)
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        self._save_checkpoint(next_line)
+        elapsed = max(time.time() - started, 1e-6)
+        self.log.write("{} datapoints in {} requests, {:.0f} points/s\n"
+                       .format(self.points, self.requests,
+                               self.points / elapsed))
+        return self.points
+
+    def _register(self, first_line):
+        """Records a batch starting at first_line as in flight."""
+        batch = next(self._batches)
+        self._in_flight[batch] = first_line
+        return batch
+
+    def _datapoints_manager(self, feed_id, datastream_id):
+        with self._lock:
+            feed = self._feeds.get(feed_id)
+        if feed is None:
+            feed = self.api.feeds.get(feed_id)
+            with self._lock:
+                self._feeds[feed_id] = feed
+        datastream = cosm.Datastream(id=datastream_id)
+        datastream._manager = feed.datastreams
+        return datastream.datapoints
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch, key, datapoints = item
+            try:
+                if self.limiter is not None:
+                    self.limiter.acquire()
+                self._datapoints_manager(*key).create(datapoints)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            with self._lock:
+                self.points += len(datapoints)
+                self.requests += 1
+                del self._in_flight[batch]
+                pending = list(self._in_flight.values())
+                pending.extend(line for line, _ in self._buffers.values())
+            if pending:
+                self._save_checkpoint(min(pending))
+
+    def _save_checkpoint(self, line):
+        if not self.checkpoint:
+            return
+        with self._lock:
+            with open(self.checkpoint + '.tmp', 'w') as f:
+                json.dump({'line': line}, f)
+            os.rename(self.checkpoint + '.tmp', self.checkpoint)
+
+
+def parse_mapping(value):
+    """Parses COLUMN=FEED:DATASTREAM."""
+    column, _, stream = value.partition('=')
+    feed_id, _, datastream_id = stream.partition(':')
+    if not (column and feed_id and datastream_id):
+        raise argparse.ArgumentTypeError(
+            "expected COLUMN=FEED:DATASTREAM, got {!r}".format(value))
+    return column, (int(feed_id), datastream_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='cosm-import',
+        description="Import CSV or NDJSON datapoints into Cosm datastreams.")
+    parser.add_argument('input')
+    parser.add_argument('--key', default=os.environ.get('COSM_API_KEY'),
+                        help="API key, defaults to $COSM_API_KEY")
+    parser.add_argument('--format', choices=('csv', 'ndjson'),
+                        help="defaults to the input's extension")
+    parser.add_argument('--map', type=parse_mapping, action='append',
+                        metavar='COLUMN=FEED:DATASTREAM', dest='mapping')
+    parser.add_argument('--at-column', default='at')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float,
+                        help="maximum requests per second")
+    args = parser.parse_args(argv)
+    if not args.key:
+        parser.error("an API key is required")
+    format = args.format
+    if format is None:
+        format = 'ndjson' if '.ndjson' in args.input else 'csv'
+    uploader = Uploader(cosm.api.Client(args.key),
+                        batch_size=args.batch_size, workers=args.workers,
+                        rate=args.rate,
+                        checkpoint=args.input + '.cosm-import')
+    with open_input(args.input) as f:
+        rows = read_rows(read_records(f, format),
+                         mapping=dict(args.mapping or []),
+                         at_column=args.at_column)
+        uploader.run(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the higher level tools built on the Cosm API."""
+
+import sys
+import threading
+import time
+
+
+class RateLimiter(object):
+    """A token bucket allowing `rate` acquisitions per second on average.
+
+    Up to `burst` acquisitions may happen back to back before callers have to
+    wait for the bucket to refill.
+
+    """
+
+    #: Slack absorbing the rounding of refills, so that acquire never waits
+    #: for a fraction of a token too small to advance the clock.
+    EPSILON = 1e-9
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = max(0.0, now - self._updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Takes tokens from the bucket if available, returning success."""
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens - self.EPSILON:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Blocks until tokens could be taken from the bucket."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens - self.EPSILON:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+def map_concurrently(func, items, workers=8):
+    """Returns [func(item) for item in items] computed on worker threads.
+
+    Results keep the order of `items`.  If any call raised, the first
+    exception is re-raised once all workers finished.
+
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][1]
+    return results
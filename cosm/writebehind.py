@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Write-behind datastream updates.
+
+Once a `WriteBehind` is attached to an API client, `DatastreamsManager.update`
+(and so `Datastream.update`) returns immediately.  Updates wait in one slot
+per datastream, where later values replace earlier ones, and are sent by a
+background thread every `interval` seconds as one feed update per feed:
+
+    write_behind = WriteBehind(interval=1.0, keep_datapoints=True)
+    write_behind.attach(client)
+    feed.datastreams.update("energy", current_value=294)
+    write_behind.close()
+
+"""
+
+import logging
+import threading
+
+from collections import OrderedDict
+from datetime import datetime
+
+
+log = logging.getLogger(__name__)
+
+#: Client errors which may succeed when sent again.
+RETRYABLE_STATUSES = (408, 429)
+
+
+class WriteBehind(object):
+    """Coalesces datastream updates and sends them in the background.
+
+    With `keep_datapoints` every `current_value` update is also kept as a
+    datapoint, so that the values replaced before a flush are not lost.
+    Failed flushes are logged and retried with the next flush, unless a
+    newer value has been given in the meantime.  Updates refused with a
+    4xx status (other than 408 and 429) are dropped and counted instead,
+    as sending them again would fail the same way.
+
+    After `close` the attached clients send their updates straight away
+    again.
+
+    """
+
+    def __init__(self, interval=1.0, keep_datapoints=False,
+                 now=datetime.utcnow):
+        self.interval = interval
+        self.keep_datapoints = keep_datapoints
+        self.now = now
+        self.stats = dict.fromkeys(
+            ['updates', 'requests', 'errors', 'dropped'], 0)
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        self._clients = []
+
+    def attach(self, api):
+        """Defers the datastream updates of an API client."""
+        api.client.write_behind = self
+        self._clients.append(api.client)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def update(self, datastreams_manager, datastream_id, fields):
+        """Records an update of a datastream for the next flush."""
+        fields = dict(fields)
+        fields.pop('id', None)
+        feed_url = datastreams_manager.base_url.rsplit('/datastreams', 1)[0]
+        with self._lock:
+            client, slots = self._pending.setdefault(
+                feed_url, (datastreams_manager.client, OrderedDict()))
+            slot = slots.setdefault(datastream_id, ({}, []))
+            slot[0].update(fields)
+            if self.keep_datapoints and 'current_value' in fields:
+                slot[1].append({'at': self.now(),
+                                'value': fields['current_value']})
+            self.stats['updates'] += 1
+
+    def pending(self):
+        """Returns the number of datastreams waiting to be sent."""
+        with self._lock:
+            return sum(len(slots) for _, slots in self._pending.values())
+
+    def flush(self):
+        """Sends every pending update, raising the first error."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+            error = None
+            for feed_url, (client, slots) in pending.items():
+                try:
+                    response = client.put(
+                        feed_url, data=self._payload(slots))
+                    response.raise_for_status()
+                except Exception as e:
+                    retry = _retryable(e)
+                    if retry:
+                        self._restore(feed_url, client, slots)
+                    with self._lock:
+                        self.stats['errors'] += 1
+                        if not retry:
+                            self.stats['dropped'] += len(slots)
+                    error = error or e
+                    continue
+                with self._lock:
+                    self.stats['requests'] += 1
+            if error is not None:
+                raise error
+
+    def close(self):
+        """Stops the background thread and sends what is still pending."""
+        for client in self._clients:
+            if client.write_behind is self:
+                client.write_behind = None
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _payload(self, slots):
+        datastreams = []
+        for datastream_id, (fields, datapoints) in slots.items():
+            datastream = dict(fields, id=datastream_id)
+            if datapoints:
+                datastream['datapoints'] = datapoints
+            datastreams.append(datastream)
+        return {'version': "1.0.0", 'datastreams': datastreams}
+
+    def _restore(self, feed_url, client, slots):
+        """Puts failed updates back, keeping values given since."""
+        with self._lock:
+            _, current = self._pending.setdefault(
+                feed_url, (client, OrderedDict()))
+            for datastream_id, (fields, datapoints) in slots.items():
+                newer = current.get(datastream_id)
+                if newer is not None:
+                    fields.update(newer[0])
+                    datapoints.extend(newer[1])
+                current[datastream_id] = (fields, datapoints)
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Flushing datastream updates failed")
+
+
+def _retryable(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    status = response.status_code
+    return not 400 <= status < 500 or status in RETRYABLE_STATUSES
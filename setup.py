@@ -9,6 +9,18 @@ setup(name='cosm-python',
       install_requires=[
           'requests >= 1.1.0',
       ],
+      extras_require={
+          'pandas': ['numpy', 'pandas'],
+          'arrow': ['numpy', 'pyarrow'],
+          'http2': ['httpx[http2]'],
+          'msgpack': ['msgpack'],
+      },
+      entry_points={
+          'console_scripts': [
+              'cosm-export = cosm.export:main',
+              'cosm-import = cosm.upload:main',
+          ],
+      },
       test_suite='nose.collector',
       tests_require=[
           'nose', 'mock'
@@ -1,21 +1,74 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import io
 import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 try:
     from io import BytesIO
 except TypeError:
     from StringIO import StringIO as BytesIO  # NOQA
 
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver  # NOQA
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # NOQA
+
 import requests
 
+try:
+    import pandas
+    import pyarrow
+except ImportError:
+    pandas = pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from mock import Mock, patch
 
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode  # NOQA
+
 import cosm
 import cosm.api
+import cosm.cache
+import cosm.codec
+import cosm.decoding
+import cosm.export
+import cosm.ledger
+import cosm.poller
+import cosm.rollup
+import cosm.scheduler
+import cosm.pool
+import cosm.resilience
+import cosm.stream
+import cosm.transport
+import cosm.triggers
+import cosm.upload
+import cosm.writebehind
+import cosm.utils
 
 
 class RequestsFixtureMixin(object):
@@ -23,13 +76,13 @@ class RequestsFixtureMixin(object):
 
     def setUp(self, *args, **kwargs):
         """Installs our own request handler."""
-        patcher = patch('cosm.Session.request')
-        self.session = patcher.start()
+        self.patcher = patch('cosm.Session.request')
+        self.session = self.patcher.start()
     setUp.__test__ = False  # Don't test this method.
 
     def tearDown(self, *args, **kwargs):
         """Ensures the original request object is reinstated."""
-        self.session.stop()
+        self.patcher.stop()
     tearDown.__test__ = False  # Don't test this method.
 
     def request(self, *args, **kwargs):
@@ -179,6 +232,37 @@ class FeedsManagerTest(BaseTestCase):
                          ('GET', u'http://api.cosm.com/v2/feeds'))
         self.assertEqual(feed.feed, u'http://api.cosm.com/v2/feeds/5853.json')
 
+    def test_snapshot(self):
+        def request(method, url, params=None, **kwargs):
+            self.assertEqual(url, 'http://api.cosm.com/v2/feeds')
+            self.assertEqual(params['datastreams'], 'energy')
+            ids = params['ids'].split(',')
+            self.assertEqual(params['per_page'], len(ids))
+            results = [{
+                'id': int(feed_id),
+                'title': "Feed {}".format(feed_id),
+                'datastreams': [
+                    {'id': 'energy', 'current_value': feed_id,
+                     'at': '2013-01-01T00:00:00.000000Z'},
+                    {'id': 'temperature', 'current_value': '20'},
+                ],
+            } for feed_id in ids if feed_id != '3']
+            response = requests.Response()
+            response.status_code = 200
+            response.raw = BytesIO(json.dumps({'results': results}).encode())
+            return response
+
+        self.session.side_effect = request
+        snapshot = self.api.feeds.snapshot(range(1, 6),
+                                           datastreams=['energy'], per_page=2)
+        self.assertEqual(self.session.call_count, 3)
+        self.assertEqual(list(snapshot), ['feed', 'datastream',
+                                          'current_value', 'at'])
+        self.assertEqual(snapshot['feed'], [1, 2, 4, 5])
+        self.assertEqual(snapshot['datastream'], ['energy'] * 4)
+        self.assertEqual(snapshot['current_value'], ['1', '2', '4', '5'])
+        self.assertEqual(snapshot['at'], [datetime(2013, 1, 1)] * 4)
+
     def test_view_feed(self):
         """Tests a request is sent to view a feed (by id) returning json."""
         response = requests.Response()
@@ -324,6 +408,33 @@ class DatastreamsManagerTest(BaseTestCase):
         self.session.assert_called_with(
             'DELETE', 'http://api.cosm.com/v2/feeds/7021/datastreams/energy')
 
+    def _get_feed(self):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = BytesIO(GET_FEED_JSON)
+        self.session.return_value = response
+        return cosm.api.Client("API_KEY").feeds.get(7021)
+
+    def test_datastreams_by_id(self):
+        datastreams = self._get_feed().datastreams
+        self.assertEqual(datastreams.ids(), ["3", "4"])
+        self.assertEqual(datastreams["4"].id, "4")
+        self.assertEqual(datastreams[0].id, "3")
+        self.assertTrue("3" in datastreams)
+        self.assertTrue(datastreams["3"] in datastreams)
+        self.assertFalse("energy" in datastreams)
+        self.assertRaises(KeyError, lambda: datastreams["energy"])
+
+    def test_create_and_delete_update_index(self):
+        datastreams = self._get_feed().datastreams
+        self.session.return_value = Mock()
+        datastreams.create("energy", current_value=211)
+        self.assertEqual(datastreams["energy"].current_value, 211)
+        datastreams.delete("3")
+        self.assertEqual(datastreams.ids(), ["4", "energy"])
+        self.assertEqual(datastreams["energy"].id, "energy")
+        self.assertFalse("3" in datastreams)
+
 
 class DatapointTest(BaseTestCase):
 
@@ -450,6 +561,62 @@ class DatapointsManagerTest(BaseTestCase):
             'http://api.cosm.com/v2/feeds/1977/datastreams/1/datapoints',
             params={'start': '2010-07-28T07:48:22.014326Z'})
 
+    def _load(self, *seconds):
+        start = datetime(2013, 1, 1)
+        self.datastream.datapoints = [
+            cosm.Datapoint(at=start + timedelta(seconds=s), value=str(s))
+            for s in seconds]
+        return self.datastream.datapoints
+
+    def test_loaded_datapoints_are_sorted(self):
+        datapoints = self._load(20, 0, 10)
+        self.assertEqual([d.value for d in datapoints], ["0", "10", "20"])
+        at = datetime(2013, 1, 1, 0, 0, 10)
+        self.assertEqual(datapoints.at_or_before(at).value, "10")
+        datastream = cosm.Datastream(id="1", datapoints=[
+            {'at': datetime(2013, 1, 2), 'value': "2"},
+            {'at': datetime(2013, 1, 1), 'value': "1"}])
+        self.assertEqual([d['value'] for d in datastream.datapoints],
+                         ["1", "2"])
+
+    def test_between(self):
+        datapoints = self._load(0, 10, 20, 30, 40)
+        view = datapoints.between(datetime(2013, 1, 1, 0, 0, 10),
+                                  datetime(2013, 1, 1, 0, 0, 30))
+        self.assertEqual([d.value for d in view], ["10", "20", "30"])
+        self.assertEqual(view[-1].value, "30")
+        self.assertEqual([d.value for d in view[1:]], ["20", "30"])
+        self.assertRaises(IndexError, lambda: view[3])
+        self.assertEqual(len(datapoints.between(datetime(2013, 1, 2),
+                                                datetime(2013, 1, 3))), 0)
+        view = datapoints.between(datetime(2013, 1, 1, 0, 0, 30),
+                                  datetime(2013, 1, 1, 0, 0, 10))
+        self.assertEqual(len(view), 0)
+        self.assertEqual(list(view), [])
+
+    def test_at_or_before_and_nearest(self):
+        datapoints = self._load(0, 10, 20)
+        self.assertEqual(datapoints.at_or_before(datetime(2012, 12, 31)),
+                         None)
+        at = datetime(2013, 1, 1, 0, 0, 14)
+        self.assertEqual(datapoints.at_or_before(at).value, "10")
+        self.assertEqual(datapoints.nearest(at).value, "10")
+        at = datetime(2013, 1, 1, 0, 0, 16)
+        self.assertEqual(datapoints.nearest(at).value, "20")
+        self.assertEqual(datapoints.nearest(datetime(2014, 1, 1)).value,
+                         "20")
+
+    def test_windows_and_resample(self):
+        datapoints = self._load(0, 5, 10, 25, 30)
+        windows = [(at.second, [d.value for d in view])
+                   for at, view in datapoints.windows(10)]
+        self.assertEqual(windows, [(0, ["0", "5"]), (10, ["10"]),
+                                   (20, ["25"]), (30, ["30"])])
+        samples = [(at.second, d.value)
+                   for at, d in datapoints.resample(10)]
+        self.assertEqual(samples, [(0, "0"), (10, "10"), (20, "10"),
+                                   (30, "30")])
+
 
 class TriggerTest(BaseTestCase):
 
@@ -522,6 +689,1591 @@ class TriggerManagerTest(BaseTestCase):
         })
 
 
+class StreamServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """A local stand-in for the Cosm socket server."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, drop_first=False):
+        socketserver.TCPServer.__init__(
+            self, ('127.0.0.1', 0), StreamRequestHandler)
+        self.drop_first = drop_first
+        self.subscriptions = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StreamRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            message = json.loads(line.decode('utf8'))
+            self.server.subscriptions.append(message)
+            if self.server.drop_first:
+                self.server.drop_first = False
+                return
+            self.send({'status': 200, 'resource': message['resource'],
+                       'token': message['token']})
+            body = {'id': "energy", 'current_value': "42",
+                    'at': "2013-02-22T12:14:40.123456Z"}
+            if 'datastreams' not in message['resource']:
+                body = {'id': 504, 'title': "Area 51", 'datastreams': [body]}
+            self.send({'resource': message['resource'],
+                       'token': message['token'], 'body': body})
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode('utf8') + b'\n')
+
+
+class StreamClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StreamServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _client(self):
+        host, port = self.server.server_address
+        return cosm.stream.Client("API_KEY", host=host, port=port,
+                                  reconnect_delay=0.01)
+
+    def test_subscribe_datastream(self):
+        with self._client() as client:
+            subscription = client.subscribe(504, "energy")
+            sub, datastream = next(client.updates(timeout=5))
+        self.assertEqual(sub, subscription)
+        self.assertEqual(subscription.status, 200)
+        self.assertEqual(datastream.id, "energy")
+        self.assertEqual(datastream.current_value, "42")
+        self.assertEqual(datastream.datapoints[0].at,
+                         datetime(2013, 2, 22, 12, 14, 40, 123456))
+        self.assertEqual(self.server.subscriptions[0]['headers'],
+                         {'X-ApiKey': "API_KEY"})
+        self.assertEqual(self.server.subscriptions[0]['resource'],
+                         "/feeds/504/datastreams/energy")
+
+    def test_subscribe_feed_with_callback(self):
+        received = []
+        done = threading.Event()
+
+        def callback(subscription, feed):
+            received.append(feed)
+            done.set()
+
+        with self._client() as client:
+            client.subscribe(504, callback=callback)
+            self.assertTrue(done.wait(5))
+        self.assertEqual(received[0].title, "Area 51")
+        self.assertEqual(received[0].datastreams[0].id, "energy")
+
+    def test_resubscribe_on_reconnect(self):
+        self.server.drop_first = True
+        with self._client() as client:
+            client.subscribe(504, "energy")
+            next(client.updates(timeout=5))
+            self.assertEqual(client.connections, 2)
+        (first, second) = self.server.subscriptions
+        self.assertEqual(first['token'], second['token'])
+
+    def test_bad_updates_are_skipped(self):
+        client = self._client()
+        received = []
+
+        def callback(subscription, update):
+            if update.id == "broken":
+                raise ValueError(update.id)
+            received.append(update)
+
+        feed = cosm.stream.Subscription(504, callback=callback)
+        datastream = cosm.stream.Subscription(504, "energy")
+        for subscription in (feed, datastream):
+            client._subscriptions[subscription.token] = subscription
+
+        def handle(subscription, body):
+            client._handle(json.dumps({'token': subscription.token,
+                                       'body': body}).encode('utf8'))
+
+        handle(feed, {'id': "broken"})
+        handle(feed, {'id': 504, 'datastreams': [{'id': "energy"}]})
+        handle(datastream, {'id': "energy", 'current_value': "1",
+                            'at': "2013-02-22T12:14:40Z"})
+        handle(datastream, {'id': "energy", 'current_value': "2",
+                            'at': "yesterday"})
+        self.assertEqual(received[0].title, None)
+        self.assertEqual(received[0].datastreams[0].id, "energy")
+        updates = list(client.updates(timeout=0))
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0][1].datapoints[0].at,
+                         datetime(2013, 2, 22, 12, 14, 40))
+
+
+class FakeClock(object):
+    """A clock which only moves when slept on."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_acquire_waits_for_tokens(self):
+        clock = FakeClock()
+        limiter = cosm.utils.RateLimiter(2, clock=clock, sleep=clock.sleep)
+        for _ in range(4):
+            limiter.acquire()
+        self.assertEqual(clock.now, 1001.0)
+        self.assertFalse(limiter.try_acquire())
+
+
+class PollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.api = Mock()
+        self.values = {7021: "1", 504: "1"}
+        self.api.feeds.get.side_effect = lambda id, **params: self._feed(id)
+        self.api.feeds.list.side_effect = lambda ids, **params: [
+            self._feed(int(id)) for id in ids.split(',')]
+        self.poller = cosm.poller.Poller(
+            self.api, interval=60, min_interval=10, max_interval=240,
+            backoff=2, clock=self.clock, sleep=self.clock.sleep)
+
+    def _feed(self, id):
+        datastream = cosm.Datastream(
+            id="energy", current_value=self.values[id],
+            at="2013-01-01T00:00:00.000000Z")
+        return cosm.Feed(title="Feed", id=id, datastreams=[datastream])
+
+    def test_poll_single_feed(self):
+        self.poller.watch(7021)
+        ((feed_id, datastream),) = self.poller.poll()
+        self.assertEqual(feed_id, 7021)
+        self.assertEqual(datastream.current_value, "1")
+        self.api.feeds.get.assert_called_with(7021)
+
+    def test_batches_due_feeds(self):
+        self.poller.watch(7021)
+        self.poller.watch(504)
+        self.assertEqual(len(self.poller.poll()), 2)
+        self.api.feeds.list.assert_called_with(ids="7021,504", per_page=2)
+        self.assertEqual(self.poller.requests, 1)
+
+    def test_emits_only_changes_and_adapts_interval(self):
+        self.poller.watch(7021)
+        self.poller.poll()
+        self.clock.now += 60
+        self.assertEqual(self.poller.poll(), [])
+        self.assertEqual(self.poller.interval_for(7021), 120)
+        self.clock.now += 60
+        self.assertEqual(self.poller.poll(), [])
+        self.clock.now += 60
+        self.values[7021] = "2"
+        ((feed_id, datastream),) = self.poller.poll()
+        self.assertEqual(datastream.current_value, "2")
+        self.assertEqual(self.poller.interval_for(7021), 60)
+
+    def test_rate_limit(self):
+        poller = cosm.poller.Poller(self.api, batch_size=1, max_rate=1,
+                                    clock=self.clock, sleep=self.clock.sleep)
+        poller.watch(7021)
+        poller.watch(504)
+        poller.poll()
+        self.assertEqual(self.clock.now, 1001.0)
+
+    def test_failed_fetch_is_retried_later(self):
+        self.values[1] = "1"
+
+        def get(id, **params):
+            if id == 504:
+                raise IOError("timed out")
+            return self._feed(id)
+
+        self.api.feeds.get.side_effect = get
+        poller = cosm.poller.Poller(self.api, interval=60, batch_size=1,
+                                    clock=self.clock, sleep=self.clock.sleep)
+        for feed_id in (7021, 504, 1):
+            poller.watch(feed_id)
+        self.assertRaises(IOError, poller.poll)
+        self.assertEqual(poller.interval_for(504), 90)
+        self.assertEqual(sorted(entry[0] for entry in poller._queue),
+                         [1060.0, 1060.0, 1090.0])
+        self.clock.now += 60
+        self.assertEqual([feed_id for feed_id, _ in poller.poll()], [1])
+        self.assertEqual(len(poller._queue), 3)
+
+    def test_changes_before_a_failed_fetch_are_reported(self):
+        reported = []
+        poller = cosm.poller.Poller(
+            self.api, lambda feed_id, d: reported.append(feed_id),
+            batch_size=1, clock=self.clock, sleep=self.clock.sleep)
+        poller.watch(7021)
+        poller.watch(504)
+        poller.poll()
+        del reported[:]
+        self.values = {7021: "3", 504: "3"}
+
+        def get(id, **params):
+            if id == 504:
+                raise IOError("timed out")
+            return self._feed(id)
+
+        self.api.feeds.get.side_effect = get
+        self.clock.now += 60
+        self.assertRaises(IOError, poller.poll)
+        self.assertEqual(reported, [7021])
+
+    def test_watch_wakes_run(self):
+        polled = threading.Event()
+        poller = cosm.poller.Poller(self.api, lambda *args: polled.set(),
+                                    max_interval=60)
+        thread = threading.Thread(target=poller.run)
+        thread.start()
+        try:
+            time.sleep(0.05)
+            poller.watch(7021)
+            self.assertTrue(polled.wait(2))
+        finally:
+            poller.stop()
+            thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+
+class TriggersSyncTest(BaseTestCase):
+
+    def setUp(self):
+        super(TriggersSyncTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.session.side_effect = self.request
+        self.triggers = [
+            {'id': 1, 'environment_id': 8470, 'stream_id': "0",
+             'url': "http://example.com/a", 'trigger_type': "lt",
+             'threshold_value': "15.0"},
+            {'id': 2, 'environment_id': 8470, 'stream_id': "1",
+             'url': "http://example.com/a", 'trigger_type': "gt",
+             'threshold_value': "30.0"},
+            {'id': 3, 'environment_id': 8470, 'stream_id': "2",
+             'url': "http://example.com/a", 'trigger_type': "change"},
+        ]
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url))
+        response = requests.Response()
+        response.status_code = 200
+        if method == 'GET':
+            page = kwargs['params']['page']
+            per_page = kwargs['params']['per_page']
+            start = (page - 1) * per_page
+            triggers = self.triggers[start:start + per_page]
+            response.raw = BytesIO(json.dumps(triggers).encode('utf8'))
+        elif method == 'POST':
+            response.status_code = 201
+            response.headers['location'] = "http://api.cosm.com/v2/triggers/4"
+        return response
+
+    def test_list_paginates(self):
+        triggers = list(self.api.triggers.list(per_page=2))
+        self.assertEqual([t.id for t in triggers], [1, 2, 3])
+        self.assertEqual(self.calls, [
+            ('GET', 'http://api.cosm.com/v2/triggers'),
+            ('GET', 'http://api.cosm.com/v2/triggers'),
+        ])
+
+    def test_update_and_delete(self):
+        trigger = self.api.triggers._coerce_to_trigger(dict(self.triggers[0]))
+        trigger.threshold_value = "20.0"
+        trigger.update()
+        trigger.delete()
+        self.assertEqual(self.calls, [
+            ('PUT', 'http://api.cosm.com/v2/triggers/1'),
+            ('DELETE', 'http://api.cosm.com/v2/triggers/1'),
+        ])
+
+    def test_sync(self):
+        desired = [
+            cosm.Trigger(8470, "0", "http://example.com/a", "lt", 15),
+            cosm.Trigger(8470, "1", "http://example.com/a", "gt", 35),
+            cosm.Trigger(8470, "3", "http://example.com/a", "lt", "0"),
+        ]
+        result = self.api.triggers.sync(desired)
+        self.assertEqual([t.id for t in result['created']], [4])
+        self.assertEqual([t.id for t in result['updated']], [2])
+        self.assertEqual([t.id for t in result['deleted']], [3])
+        self.assertFalse(any('id' in t._data for t in desired))
+        self.assertEqual(sorted(self.calls[1:]), [
+            ('DELETE', 'http://api.cosm.com/v2/triggers/3'),
+            ('POST', 'http://api.cosm.com/v2/triggers'),
+            ('PUT', 'http://api.cosm.com/v2/triggers/2'),
+        ])
+
+
+class TriggerReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.receiver = cosm.triggers.Receiver(
+            [lambda *args: self.received.append(args)], queue_size=1)
+
+    def _post(self, payload):
+        body = urlencode({'body': payload}).encode('utf8')
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': BytesIO(body),
+        }
+        start_response = Mock()
+        self.receiver(environ, start_response)
+        return start_response.call_args[0][0]
+
+    def test_dispatch_notification(self):
+        self.assertEqual(self._post(TRIGGER_NOTIFICATION_JSON), '200 OK')
+        self.receiver.close()
+        ((trigger, datastream),) = self.received
+        self.assertEqual(trigger.id, 1)
+        self.assertEqual(trigger.environment_id, 504)
+        self.assertEqual(trigger.trigger_type, "gt")
+        self.assertEqual(trigger.notified_at, datetime(2010, 7, 7, 13, 51, 21))
+        self.assertEqual(datastream.id, "0")
+        self.assertEqual(datastream.current_value, "23.3")
+        self.assertEqual(datastream.datapoints[0].at,
+                         datetime(2010, 7, 7, 13, 51, 20, 123456))
+        metrics = self.receiver.metrics()
+        self.assertEqual(metrics['processed'], 1)
+        self.assertEqual(metrics['queue_depth'], 0)
+
+    def test_redelivery_is_deduplicated(self):
+        self._post(TRIGGER_NOTIFICATION_JSON)
+        self.assertEqual(self._post(TRIGGER_NOTIFICATION_JSON), '200 OK')
+        self.receiver.close()
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.receiver.metrics()['duplicates'], 1)
+
+    def test_backpressure(self):
+        self.receiver.workers = 0
+        self._post(TRIGGER_NOTIFICATION_JSON)
+        other = TRIGGER_NOTIFICATION_JSON.replace('"id": 1,', '"id": 2,')
+        self.assertEqual(self._post(other), '503 Service Unavailable')
+        self.assertEqual(self.receiver.metrics()['rejected'], 1)
+
+    def test_invalid_payload(self):
+        self.assertEqual(self._post('{}'), '400 Bad Request')
+
+
+class CompressionTest(BaseTestCase):
+
+    def setUp(self):
+        super(CompressionTest, self).setUp()
+        self.client = cosm.Client("API_KEY", compress_threshold=64)
+
+    def test_large_body_is_compressed(self):
+        data = {'datapoints': [{'at': datetime(2013, 1, 1), 'value': i}
+                               for i in range(100)]}
+        self.client.post('/v2/feeds/504/datastreams/1/datapoints', data=data)
+        kwargs = self.session.call_args[1]
+        self.assertEqual(kwargs['headers'], {'Content-Encoding': 'gzip'})
+        body = gzip.GzipFile(fileobj=BytesIO(kwargs['data'])).read()
+        self.assertEqual(body.decode('utf8'), self.client._encode_data(data))
+        stats = self.client.compression_stats
+        self.assertEqual(stats['requests_compressed'], 1)
+        self.assertEqual(stats['request_bytes_sent'], len(kwargs['data']))
+        self.assertTrue(self.client.bytes_saved() > 0)
+
+    def test_small_body_is_not_compressed(self):
+        self.client.put('/v2/feeds/504', data={'private': True})
+        self.session.assert_called_with(
+            'PUT', 'http://api.cosm.com/v2/feeds/504',
+            data='{"private": true}')
+
+    def test_accept_encoding(self):
+        self.assertEqual(self.client.headers['Accept-Encoding'],
+                         'gzip, deflate')
+        client = cosm.Client("API_KEY", accept_compressed=False)
+        self.assertEqual(client.headers['Accept-Encoding'], 'identity')
+
+
+class FakeHistory(object):
+    """Stands in for a DatapointsManager with one datapoint a minute."""
+
+    history_url = 'http://api.cosm.com/v2/feeds/504/datastreams/1'
+
+    def __init__(self):
+        self.queries = []
+
+    def history(self, start, end, limit=None, **params):
+        self.queries.append((start, end))
+        at = start.replace(second=0, microsecond=0)
+        while at <= end and limit != 0:
+            if at >= start:
+                yield cosm.Datapoint(at, str(at.minute))
+                limit = limit and limit - 1
+            at += timedelta(minutes=1)
+
+
+class HistoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cosm.cache.HistoryCache(
+            max_points=100, now=lambda: datetime(2013, 1, 2))
+        self.manager = FakeHistory()
+
+    def _history(self, start_minute, end_minute, manager=None):
+        return self.cache.history(
+            manager or self.manager,
+            start=datetime(2013, 1, 1, 12, start_minute),
+            end=datetime(2013, 1, 1, 12, end_minute))
+
+    def test_only_missing_ranges_are_fetched(self):
+        self.assertEqual(len(self._history(10, 20)), 11)
+        self.assertEqual(len(self._history(30, 40)), 11)
+        datapoints = self._history(5, 45)
+        self.assertEqual([d.value for d in datapoints],
+                         [str(minute) for minute in range(5, 46)])
+        self.assertEqual(self.manager.queries[2:], [
+            (datetime(2013, 1, 1, 12, 5), datetime(2013, 1, 1, 12, 10)),
+            (datetime(2013, 1, 1, 12, 20), datetime(2013, 1, 1, 12, 30)),
+            (datetime(2013, 1, 1, 12, 40), datetime(2013, 1, 1, 12, 45)),
+        ])
+        self._history(15, 35)
+        self.assertEqual(len(self.manager.queries), 5)
+
+    def test_recent_ranges_are_refetched(self):
+        self.cache.now = lambda: datetime(2013, 1, 1, 12, 30)
+        self._history(20, 40)
+        self._history(20, 40)
+        self.assertEqual(self.manager.queries[1],
+                         (datetime(2013, 1, 1, 12, 29),
+                          datetime(2013, 1, 1, 12, 40)))
+
+    def test_evicts_least_recently_used(self):
+        other = FakeHistory()
+        other.history_url += '0'
+        self._history(0, 59)
+        self._history(0, 59, manager=other)
+        self.assertEqual(self.cache.points, 60)
+        self._history(0, 59)
+        self.assertEqual(len(self.manager.queries), 2)
+
+    def test_long_ranges_are_paged(self):
+        self.cache.page_size = 25
+        self.assertEqual(len(self._history(0, 59)), 60)
+        self.assertEqual(self.manager.queries, [
+            (datetime(2013, 1, 1, 12, 0), datetime(2013, 1, 1, 12, 59)),
+            (datetime(2013, 1, 1, 12, 24, 0, 1),
+             datetime(2013, 1, 1, 12, 59)),
+            (datetime(2013, 1, 1, 12, 49, 0, 1),
+             datetime(2013, 1, 1, 12, 59)),
+        ])
+        self.assertEqual(len(self._history(0, 59)), 60)
+        self.assertEqual(len(self.manager.queries), 3)
+
+
+class RecentValuesStoreTest(BaseTestCase):
+
+    def setUp(self):
+        super(RecentValuesStoreTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.client = self.api.client
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='1')
+        self.store = cosm.cache.RecentValuesStore(
+            capacity=3, now=lambda: datetime(2013, 1, 1, 12, 10))
+        self.store.attach(self.api)
+
+    def _create(self, *minutes):
+        self.datastream.datapoints.create([
+            {'at': datetime(2013, 1, 1, 12, minute), 'value': minute}
+            for minute in minutes])
+
+    def test_failing_hook_does_not_fail_create(self):
+        def hook(manager, datapoints):
+            raise ValueError("broken")
+
+        self.client.datapoint_hooks.insert(0, hook)
+        self._create(1)
+        self.assertEqual(self.store.current(self.datastream.datapoints).value,
+                         1)
+
+    def test_records_created_datapoints(self):
+        self._create(1, 2, 3, 4)
+        datapoints = self.store.last(self.datastream.datapoints, 5)
+        self.assertEqual([d.value for d in datapoints], [2, 3, 4])
+        self.assertEqual(self.store.current(self.datastream.datapoints).value,
+                         4)
+
+    def test_since(self):
+        self._create(5, 9, 7)
+        datapoints = self.store.since(self.datastream.datapoints, 240)
+        self.assertEqual([d.value for d in datapoints], [7, 9])
+
+    def test_unknown_datastream(self):
+        self.assertEqual(self.store.current(self.datastream.datapoints), None)
+        self.assertEqual(self.store.last(self.datastream.datapoints, 2), [])
+
+
+@unittest.skipIf(pandas is None, "pandas and pyarrow are required")
+class HistoryFrameTest(BaseTestCase):
+
+    def setUp(self):
+        super(HistoryFrameTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.client = self.api.client
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='random5')
+
+    def _respond(self, body):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = BytesIO(body)
+        self.session.return_value = response
+
+    def test_datastream_history_frame(self):
+        self._respond(HISTORY_DATASTREAM_JSON)
+        frame = self.datastream.datapoints.history_frame(interval=900)
+        self.assertEqual(frame.index[0],
+                         pandas.Timestamp(2013, 1, 1, 14, 14, 55, 118845))
+        self.assertEqual(frame['value'].dtype, 'float64')
+        self.assertAlmostEqual(frame['value'].iloc[0], 0.2574197)
+
+    def test_datastream_history_arrow(self):
+        self._respond(HISTORY_DATASTREAM_JSON)
+        table = self.datastream.datapoints.history_arrow()
+        self.assertEqual(table.column_names, ['at', 'value'])
+        self.assertEqual(str(table.schema.field('at').type), 'timestamp[us]')
+
+    def test_feed_history_frame(self):
+        self._respond(HISTORY_FEED_JSON)
+        frame = self.api.feeds.history_frame(61916, interval=900)
+        self.assertEqual(sorted(set(frame['datastream'])),
+                         ["random5", "random60", "random900"])
+        self.assertEqual(frame.index.name, 'at')
+
+
+class ClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = cosm.pool.ClientPool(["KEY1", "KEY2"],
+                                         owners={504: "KEY2"})
+        self.calls = []
+        self.status = {}
+        for client in self.pool.client.clients:
+            client.request = self._request(client.auth.key)
+
+    def _request(self, key):
+        def request(method, url, **kwargs):
+            self.calls.append((key, method, url))
+            response = requests.Response()
+            response.status_code = self.status.get(key, 200)
+            if method == 'GET':
+                response.raw = BytesIO(GET_FEED_JSON)
+            else:
+                response.headers['location'] = (
+                    'http://api.cosm.com/v2/feeds/7021')
+            return response
+        return request
+
+    def test_owned_feed_uses_owner_key(self):
+        self.pool.feeds.get(504)
+        self.pool.feeds.update(504, private=True)
+        self.assertEqual([call[0] for call in self.calls], ["KEY2", "KEY2"])
+
+    def test_public_reads_are_spread(self):
+        for _ in range(4):
+            self.pool.feeds.get(61916)
+        self.assertEqual([call[0] for call in self.calls],
+                         ["KEY1", "KEY2", "KEY1", "KEY2"])
+
+    def test_learns_owner_of_created_feed(self):
+        self.pool.feeds.create(title="Area 51")
+        self.pool.feeds.get(7021)
+        self.pool.feeds.get(7021)
+        self.assertEqual([call[0] for call in self.calls],
+                         ["KEY1", "KEY1", "KEY1"])
+
+    def test_throttled_key_is_rested(self):
+        self.status["KEY1"] = 429
+        self.pool.feeds.get(61916)
+        self.status.pop("KEY1")
+        self.pool.feeds.get(61916)
+        self.pool.feeds.get(61916)
+        self.assertEqual([call[0] for call in self.calls],
+                         ["KEY1", "KEY2", "KEY2", "KEY2"])
+        self.assertEqual(self.pool.client.stats["KEY1"],
+                         {'requests': 1, 'throttled': 1})
+
+    def test_throttled_read_does_not_learn_owner(self):
+        pool = cosm.pool.ClientPool(["KEY1", "KEY2"], throttle_delay=0)
+        for client in pool.client.clients:
+            client.request = self._request(client.auth.key)
+        self.status["KEY1"] = 429
+        pool.feeds.get(61916)
+        self.status.pop("KEY1")
+        pool.feeds.get(61916)
+        pool.feeds.get(61916)
+        self.assertEqual([call[0] for call in self.calls],
+                         ["KEY1", "KEY2", "KEY2", "KEY1"])
+        self.assertEqual(pool.client.owners, {})
+
+    def test_refused_read_learns_owner(self):
+        self.status["KEY1"] = 404
+        self.pool.feeds.get(61916)
+        self.status.pop("KEY1")
+        self.pool.feeds.get(61916)
+        self.pool.feeds.get(61916)
+        self.assertEqual([call[0] for call in self.calls],
+                         ["KEY1", "KEY2", "KEY2", "KEY2"])
+
+
+class DecodingTest(BaseTestCase):
+
+    def setUp(self):
+        super(DecodingTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.client = self.api.client
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='random5')
+
+    def test_parse_timestamp(self):
+        micros = cosm.decoding.parse_timestamp("2013-01-01T14:14:55.118845Z")
+        self.assertEqual(cosm.decoding.to_datetime(micros),
+                         datetime(2013, 1, 1, 14, 14, 55, 118845))
+        micros = cosm.decoding.parse_timestamp("2013-01-01T14:14:55Z")
+        self.assertEqual(cosm.decoding.to_datetime(micros),
+                         datetime(2013, 1, 1, 14, 14, 55))
+
+    def test_decode_feeds(self):
+        columns = cosm.decoding.decode_feeds(LIST_FEEDS_JSON.replace(
+            b'"title":"bridge19"', b'"id":5853,"title":"bridge19"'))
+        self.assertEqual(list(columns['feed']), [5853, 5853])
+        self.assertEqual(columns['datastream'], ["0", "1"])
+        self.assertEqual(columns['current_value'][0], 435.0)
+
+    def test_pool_history(self):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = BytesIO(HISTORY_DATASTREAM_JSON)
+        self.session.return_value = response
+        with cosm.decoding.DecodePool(processes=1) as pool:
+            columns = pool.history(self.datastream.datapoints, interval=900)
+        self.assertEqual(cosm.decoding.to_datetime(columns['at'][0]),
+                         datetime(2013, 1, 1, 14, 14, 55, 118845))
+        self.assertEqual(columns['value'][0], 0.2574197)
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_models_import_without_http_stack(self):
+        """Tests building payloads doesn't import requests."""
+        code = ("import sys, cosm\n"
+                "feed = cosm.Feed(title='Feed')\n"
+                "feed.datastreams = [cosm.Datastream(id='1')]\n"
+                "json = cosm.JSONEncoder().encode(feed)\n"
+                "print('requests' in sys.modules)\n")
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'False')
+
+    def test_client_is_importable(self):
+        self.assertTrue(issubclass(cosm.Client, cosm.Session))
+        self.assertTrue(cosm.KeyAuth)
+
+
+class WriteLedgerTest(BaseTestCase):
+
+    def setUp(self):
+        super(WriteLedgerTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.client = self.api.client
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='1')
+        self.ledger = cosm.ledger.WriteLedger()
+        self.stored = {}
+        self.posts = []
+        self.session.side_effect = self.request
+
+    def request(self, method, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        if method == 'POST':
+            payload = json.loads(kwargs['data'])
+            self.posts.append(payload['datapoints'])
+            for datapoint in payload['datapoints'][:2]:
+                self.stored[datapoint['at']] = datapoint['value']
+            if len(self.posts) == 1:
+                raise requests.Timeout()
+        elif method == 'GET':
+            datapoints = [{'at': at.replace('Z', '.000000Z'), 'value': value}
+                          for at, value in sorted(self.stored.items())]
+            body = json.dumps({'datapoints': datapoints})
+            response.raw = BytesIO(body.encode('utf8'))
+        return response
+
+    def _datapoints(self, *seconds):
+        return [{'at': datetime(2013, 1, 1, 12, 0, s), 'value': str(s)}
+                for s in seconds]
+
+    def test_resends_only_missing_after_timeout(self):
+        datapoints = self.ledger.create(self.datastream.datapoints,
+                                        self._datapoints(1, 2, 3, 4))
+        self.assertEqual(len(datapoints), 4)
+        self.assertEqual([d['value'] for d in self.posts[1]], ["3", "4"])
+        self.assertEqual(self.ledger.stats['resent'], 2)
+        self.assertEqual(self.ledger.in_flight(), [])
+
+    def test_collapses_duplicate_points(self):
+        self.posts.append([])
+        datapoints = self.ledger.create(
+            self.datastream.datapoints,
+            self._datapoints(1, 2) + [{'at': datetime(2013, 1, 1, 12, 0, 1),
+                                       'value': "one"}])
+        self.assertEqual([d.value for d in datapoints], ["one", "2"])
+        self.assertEqual(self.ledger.stats['collapsed'], 1)
+
+    def test_verification_is_retried(self):
+        request = self.request
+        reads = []
+
+        def flaky(method, url, **kwargs):
+            if method == 'GET':
+                reads.append(url)
+                if len(reads) == 1:
+                    raise requests.Timeout()
+            return request(method, url, **kwargs)
+
+        self.session.side_effect = flaky
+        datapoints = self.ledger.create(self.datastream.datapoints,
+                                        iter(self._datapoints(1, 2, 3)))
+        self.assertEqual(len(datapoints), 3)
+        self.assertEqual(len(reads), 2)
+        self.assertEqual([d['value'] for d in self.posts[1]], ["3"])
+
+    def test_waits_for_batch_sharing_points(self):
+        self.posts.append([])
+        manager = self.datastream.datapoints
+        other = cosm.ledger._Batch(OrderedDict(
+            (datetime(2013, 1, 1, 12, 0, s), str(s)) for s in (1, 2)))
+        stream = manager.history_url
+        self.ledger._pending[stream] = {'other': other}
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.ledger.create(manager, self._datapoints(1, 2, 3))))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        del self.ledger._pending[stream]
+        other.done.set()
+        thread.join(5)
+        self.assertEqual([d.value for d in results[0]], ["1", "2", "3"])
+        self.assertEqual(self.ledger.stats['collapsed'], 0)
+
+    def test_non_ambiguous_errors_are_raised(self):
+        self.session.side_effect = None
+        response = requests.Response()
+        response.status_code = 422
+        self.session.return_value = response
+        self.assertRaises(requests.HTTPError, self.ledger.create,
+                          self.datastream.datapoints, self._datapoints(1))
+
+
+class ExportTest(BaseTestCase):
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.output = tempfile.mkdtemp()
+        self.session.side_effect = self.request
+        self.history_requests = []
+        self.log = Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+        super(ExportTest, self).tearDown()
+
+    def request(self, method, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        if url.endswith('/datastreams/1'):
+            self.history_requests.append(kwargs['params'])
+            start = kwargs['params']['start']
+            body = {'datapoints': [{'at': start.replace('Z', '.000000Z'),
+                                    'value': "42"}]}
+        else:
+            body = {'id': 504, 'title': "Feed",
+                    'feed': "http://api.cosm.com/v2/feeds/504.json"}
+        response.raw = BytesIO(json.dumps(body).encode('utf8'))
+        return response
+
+    def _export(self, format='csv'):
+        exporter = cosm.export.Exporter(self.api, self.output, format=format,
+                                        window=3600, workers=2, log=self.log)
+        return exporter.run([(504, "1")], datetime(2013, 1, 1, 0),
+                            datetime(2013, 1, 1, 3))
+
+    def test_export_csv_windows(self):
+        self.assertEqual(self._export(), 3)
+        path = os.path.join(self.output, '504', '1',
+                            '20130101T010000_20130101T020000.csv.gz')
+        with gzip.open(path) as f:
+            self.assertEqual(f.read().decode('utf8').splitlines(),
+                             ['at,value', '2013-01-01T01:00:00Z,42'])
+        self.assertEqual(self.history_requests[0]['interval'], 0)
+
+    def test_export_resumes_from_checkpoint(self):
+        self._export(format='ndjson')
+        self.history_requests = []
+        self.assertEqual(self._export(format='ndjson'), 0)
+        self.assertEqual(self.history_requests, [])
+
+    def test_parse_arguments(self):
+        self.assertEqual(cosm.export.parse_stream("504:energy"),
+                         (504, "energy"))
+        self.assertEqual(cosm.export.parse_stream("504"), (504, None))
+        self.assertEqual(cosm.export.parse_datetime("2013-01-02"),
+                         datetime(2013, 1, 2))
+
+
+class UploadTest(BaseTestCase):
+
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'data.cosm-import')
+        self.session.side_effect = self.request
+        self.posts = []
+        self.log = Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(UploadTest, self).tearDown()
+
+    def request(self, method, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        if method == 'POST':
+            self.posts.append((url, json.loads(kwargs['data'])))
+        else:
+            body = {'id': 504, 'title': "Feed",
+                    'feed': "http://api.cosm.com/v2/feeds/504.json"}
+            response.raw = BytesIO(json.dumps(body).encode('utf8'))
+        return response
+
+    def _upload(self, text, **kwargs):
+        records = cosm.upload.read_records(io.StringIO(text), 'csv')
+        rows = cosm.upload.read_rows(records, **kwargs)
+        uploader = cosm.upload.Uploader(self.api, batch_size=2, workers=2,
+                                        checkpoint=self.checkpoint,
+                                        log=self.log)
+        return uploader.run(rows)
+
+    def test_upload_batches_per_datastream(self):
+        points = self._upload(
+            u"feed,datastream,at,value\n"
+            u"504,a,2013-01-01T00:00:00Z,1\n"
+            u"504,b,2013-01-01T00:00:00Z,2\n"
+            u"504,a,2013-01-01T00:01:00Z,3\n")
+        self.assertEqual(points, 3)
+        batches = sorted((url.split('/')[-2], [d['value'] for d in
+                                               payload['datapoints']])
+                         for url, payload in self.posts)
+        self.assertEqual(batches, [('a', ["1", "3"]), ('b', ["2"])])
+
+    def test_wide_mapping_and_resume(self):
+        text = (u"at,temp,rh\n"
+                u"2013-01-01T00:00:00Z,20,40\n"
+                u"2013-01-01T00:01:00Z,21,\n")
+        mapping = {'temp': (504, 'temperature'), 'rh': (504, 'humidity')}
+        self.assertEqual(self._upload(text, mapping=mapping), 3)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f), {'line': 4})
+        self.posts = []
+        self.assertEqual(self._upload(text, mapping=mapping), 0)
+        self.assertEqual(self.posts, [])
+
+    def test_open_compressed_input(self):
+        path = os.path.join(self.directory, 'data.csv.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(b"at,value\n2013-01-01T00:00:00Z,1\n")
+        with cosm.upload.open_input(path) as f:
+            records = list(cosm.upload.read_records(f, 'csv'))
+        self.assertEqual(records, [
+            (2, {'at': "2013-01-01T00:00:00Z", 'value': "1"})])
+
+
+class WriteBehindTest(BaseTestCase):
+
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.feed = cosm.Feed(id=7021, title="Rother")
+        self.feed._manager = self.api.feeds
+        self.feed._data['feed'] = 'http://api.cosm.com/v2/feeds/7021.json'
+        self.write_behind = cosm.writebehind.WriteBehind(
+            interval=3600, keep_datapoints=True,
+            now=lambda: datetime(2013, 1, 1))
+        self.write_behind.attach(self.api)
+
+    def tearDown(self):
+        self.write_behind._closed.set()
+        super(WriteBehindTest, self).tearDown()
+
+    def test_updates_are_coalesced_per_feed(self):
+        self.feed.datastreams.update("energy", current_value=1)
+        self.feed.datastreams.update("energy", current_value=2)
+        self.feed.datastreams.update("flow", current_value=3)
+        self.assertFalse(self.session.called)
+        self.write_behind.flush()
+        self.assertEqual(self.session.call_count, 1)
+        self.assertEqual(self.session.call_args[0],
+                         ('PUT', 'http://api.cosm.com/v2/feeds/7021'))
+        payload = json.loads(self.session.call_args[1]['data'])
+        self.assertEqual(payload['datastreams'], [
+            {'id': "energy", 'current_value': 2, 'datapoints': [
+                {'at': "2013-01-01T00:00:00Z", 'value': 1},
+                {'at': "2013-01-01T00:00:00Z", 'value': 2}]},
+            {'id': "flow", 'current_value': 3, 'datapoints': [
+                {'at': "2013-01-01T00:00:00Z", 'value': 3}]},
+        ])
+        self.write_behind.flush()
+        self.assertEqual(self.session.call_count, 1)
+
+    def test_failed_flush_keeps_newer_values(self):
+        response = requests.Response()
+        response.status_code = 503
+        self.session.return_value = response
+        self.feed.datastreams.update("energy", current_value=1)
+        self.assertRaises(requests.HTTPError, self.write_behind.flush)
+        self.assertEqual(self.write_behind.pending(), 1)
+        self.feed.datastreams.update("energy", current_value=2)
+        self.session.return_value = Mock()
+        self.write_behind.close()
+        payload = json.loads(self.session.call_args[1]['data'])
+        self.assertEqual(payload['datastreams'][0]['current_value'], 2)
+        self.assertEqual(len(payload['datastreams'][0]['datapoints']), 2)
+        self.assertEqual(self.write_behind.stats,
+                         {'updates': 2, 'requests': 1, 'errors': 1,
+                          'dropped': 0})
+
+    def test_refused_updates_are_dropped(self):
+        response = requests.Response()
+        response.status_code = 422
+        self.session.return_value = response
+        self.feed.datastreams.update("energy", current_value=1)
+        self.assertRaises(requests.HTTPError, self.write_behind.flush)
+        self.assertEqual(self.write_behind.pending(), 0)
+        self.assertEqual(self.write_behind.stats['dropped'], 1)
+
+    def test_updates_after_close_are_sent(self):
+        self.write_behind.close()
+        self.session.return_value = Mock()
+        self.feed.datastreams.update("energy", current_value=1)
+        self.assertEqual(self.session.call_count, 1)
+        self.assertEqual(self.write_behind.pending(), 0)
+        self.assertTrue(self.api.client.write_behind is None)
+
+
+class APIServer(socketserver.ThreadingMixIn, HTTPServer):
+    """A local stand-in for the Cosm REST API, serving one feed."""
+
+    daemon_threads = True
+
+    def __init__(self, drop_connections=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), APIRequestHandler)
+        self.drop_connections = drop_connections
+        self.hang_up = False
+        self.connections = 0
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        socketserver.ThreadingMixIn.process_request(
+            self, request, client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class APIRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, self.headers))
+        if not self.path.startswith('/v2/feeds/504'):
+            return self.respond(404, b'')
+        body = GET_FEED_JSON.replace(b'http://api.cosm.com',
+                                     self.server.url.encode('ascii'))
+        headers = {}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buffer = BytesIO()
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+                f.write(body)
+            body = buffer.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        self.respond(200, body, headers)
+
+    def do_PUT(self):
+        length = int(self.headers['Content-Length'])
+        self.server.requests.append((self.command, self.path,
+                                     self.rfile.read(length)))
+        if self.server.hang_up:
+            self.close_connection = True
+            return
+        self.respond(200, b'')
+
+    do_POST = do_PUT
+
+    def respond(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = APIServer()
+        self.api = self._api()
+
+    def tearDown(self):
+        self.api.client.close()
+        self.server.stop()
+
+    def _api(self):
+        api = cosm.api.Client(
+            "API_KEY", transport=cosm.transport.HTTPTransport(timeout=5))
+        api.client.base_url = self.server.url + '/v2/'
+        api.feeds = cosm.api.FeedsManager(api.client)
+        return api
+
+    def test_get_feed(self):
+        feed = self.api.feeds.get(504, per_page=10)
+        self.assertEqual(feed.title, "Cosm Office environment")
+        self.assertEqual([d.id for d in feed.datastreams], ["3", "4"])
+        method, path, headers = self.server.requests[0]
+        self.assertEqual(path, '/v2/feeds/504?per_page=10')
+        self.assertEqual(headers['X-ApiKey'], "API_KEY")
+        self.assertTrue(headers['User-Agent'].startswith('cosm-python/'))
+
+    def test_put_sends_json(self):
+        self.api.feeds.update(504, private=True)
+        self.assertEqual(self.server.requests[0],
+                         ('PUT', '/v2/feeds/504', b'{"private": true}'))
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.api.feeds.get(504)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_closed_connections_are_reopened(self):
+        self.server.drop_connections = True
+        for _ in range(3):
+            self.api.feeds.get(504)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_posts_are_not_resent(self):
+        self.api.feeds.get(504)
+        self.server.hang_up = True
+        self.assertRaises(requests.ConnectionError, self.api.client.post,
+                          'feeds/504/datastreams', data={'version': '1.0.0'})
+        methods = [request[0] for request in self.server.requests]
+        self.assertEqual(methods, ['GET', 'POST'])
+        self.server.hang_up = False
+        self.api.feeds.get(504)
+        self.server.hang_up = True
+        self.assertRaises(requests.ConnectionError, self.api.client.put,
+                          'feeds/504', data={'version': '1.0.0'})
+        methods = [request[0] for request in self.server.requests]
+        self.assertEqual(methods, ['GET', 'POST', 'GET', 'PUT', 'PUT'])
+
+    def test_close_closes_connections_of_all_threads(self):
+        transport = self.api.client.transport
+        for i in range(3):
+            thread = threading.Thread(target=self.api.feeds.get, args=(504,))
+            thread.start()
+            thread.join()
+        connections = list(transport._open)
+        self.assertEqual(len(connections), 3)
+        self.api.client.close()
+        self.assertTrue(all(c.sock is None for c in connections))
+        self.assertEqual(transport._open, set())
+        self.api.feeds.get(504)
+        self.assertEqual(len(transport._open), 1)
+
+    def test_errors_are_raised_like_requests(self):
+        self.assertRaises(requests.HTTPError, self.api.feeds.get, 42)
+        self.server.stop()
+        self.api.client.close()
+        self.assertRaises(requests.ConnectionError, self.api.feeds.get, 504)
+        self.server = APIServer()
+
+
+class ThreadSafeClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = APIServer()
+        self.api = cosm.api.Client("API_KEY", thread_safe=True)
+        self.api.client.base_url = self.server.url + '/v2/'
+        self.api.feeds = cosm.api.FeedsManager(self.api.client)
+
+    def tearDown(self):
+        self.api.client.close()
+        self.server.stop()
+
+    def test_threads_get_their_own_session(self):
+        clients = []
+
+        def work(i):
+            clients.append(self.api.client.client)
+            return self.api.feeds.get(504).title
+
+        titles = cosm.utils.map_concurrently(work, range(8), workers=4)
+        self.assertEqual(set(titles), set(["Cosm Office environment"]))
+        self.assertEqual(len(set(clients)), 4)
+        # One more client was made by the main thread setting base_url.
+        self.assertEqual(len(self.api.client.clients), 5)
+        self.assertTrue(all(c.base_url == self.server.url + '/v2/'
+                            for c in self.api.client.clients))
+
+    def test_clients_of_finished_threads_are_dropped(self):
+        adapter = requests.adapters.HTTPAdapter()
+        self.api.client.mount('http://', adapter)
+
+        def work():
+            self.api.client.client
+
+        for i in range(3):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        clients = self.api.client.clients
+        self.assertEqual(len(clients), 2)
+        self.assertTrue(all(c.get_adapter('http://example.com') is adapter
+                            for c in clients))
+
+    def test_hedged_gets_use_the_clients_of_workers(self):
+        resilience = cosm.resilience.Resilience(min_requests=1,
+                                                min_hedge_delay=5)
+        resilience.attach(self.api)
+        for i in range(5):
+            self.assertEqual(self.api.feeds.get(504).title,
+                             "Cosm Office environment")
+        self.assertEqual(len(resilience._workers._threads), 1)
+        clients = self.api.client.clients
+        self.assertEqual(len(clients), 2)
+        self.assertTrue(self.api.client.client is clients[0])
+
+    def test_lazy_managers_are_created_once(self):
+        feed = cosm.Feed(id=504, title="Area 51")
+        feed._manager = self.api.feeds
+        feed._data['feed'] = self.server.url + '/v2/feeds/504'
+        managers = cosm.utils.map_concurrently(
+            lambda i: feed.datastreams, range(64), workers=16)
+        self.assertEqual(len(set(map(id, managers))), 1)
+
+    def test_parallel_get_and_create(self):
+        recorded = []
+        self.api.client.datapoint_hooks.append(
+            lambda manager, datapoints: recorded.extend(datapoints))
+
+        def work(i):
+            feed = self.api.feeds.get(504)
+            datastream = feed.datastreams["3"]
+            datastream.datapoints.create([
+                {'at': datetime(2013, 1, 1) + timedelta(seconds=i),
+                 'value': i}])
+            return datastream.id
+
+        ids = cosm.utils.map_concurrently(work, range(400), workers=32)
+        self.assertEqual(set(ids), set(["3"]))
+        posts = [path for method, path, _ in self.server.requests
+                 if method == 'POST']
+        self.assertEqual(len(self.server.requests), 800)
+        self.assertEqual(set(posts),
+                         set(['/v2/feeds/504/datastreams/3/datapoints']))
+        self.assertEqual(sorted(d.value for d in recorded), list(range(400)))
+
+
+class SchedulerTest(BaseTestCase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.scheduler = cosm.scheduler.Scheduler(slots=2, reserved_slots=1)
+        self.scheduler.attach(self.api)
+
+    def test_priority_is_not_sent(self):
+        self.api.client.get('feeds/504', priority=cosm.scheduler.BULK)
+        self.session.assert_called_with(
+            'GET', 'http://api.cosm.com/v2/feeds/504', params=None,
+            allow_redirects=True)
+        self.assertEqual(self.scheduler.metrics()['bulk']['requests'], 1)
+
+    def test_priority_context_manager(self):
+        with cosm.scheduler.priority(cosm.scheduler.BULK):
+            self.api.feeds.delete(504)
+        self.api.feeds.delete(504)
+        metrics = self.scheduler.metrics()
+        self.assertEqual(metrics['bulk']['requests'], 1)
+        self.assertEqual(metrics['interactive']['requests'], 1)
+        self.assertRaises(ValueError, self.api.client.get, 'feeds',
+                          priority='urgent')
+
+    def test_slots_are_reserved_for_interactive_requests(self):
+        release = threading.Event()
+        started = []
+
+        def request(name):
+            started.append(name)
+            release.wait(5)
+
+        def call(priority, name):
+            thread = threading.Thread(target=self.scheduler.call,
+                                      args=(priority, request, name))
+            thread.start()
+            return thread
+
+        threads = [call(cosm.scheduler.BULK, 'bulk 1')]
+        while not started:
+            time.sleep(0.01)
+        threads.append(call(cosm.scheduler.BULK, 'bulk 2'))
+        while self.scheduler.metrics()['bulk']['waiting'] < 1:
+            time.sleep(0.01)
+        threads.append(call(cosm.scheduler.INTERACTIVE, 'interactive'))
+        while len(started) < 2:
+            time.sleep(0.01)
+        self.assertEqual(started, ['bulk 1', 'interactive'])
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(started[2], 'bulk 2')
+        metrics = self.scheduler.metrics()
+        self.assertEqual(metrics['bulk']['requests'], 2)
+        self.assertTrue(metrics['bulk']['latency_max'] >=
+                        metrics['interactive']['latency_max'])
+
+    def test_rate_is_reserved_for_interactive_requests(self):
+        clock = FakeClock()
+        scheduler = cosm.scheduler.Scheduler(
+            rate=10, reserved_rate=0.5, clock=clock, sleep=clock.sleep)
+        for _ in range(15):
+            scheduler.call(cosm.scheduler.BULK, lambda: None)
+        # A burst of 5 bulk requests, then 5 per second.
+        self.assertEqual(clock.now, 1002.0)
+        for _ in range(5):
+            scheduler.call(cosm.scheduler.INTERACTIVE, lambda: None)
+        self.assertEqual(clock.now, 1002.0)
+
+
+class RollupEngineTest(BaseTestCase):
+
+    def setUp(self):
+        super(RollupEngineTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        feed = cosm.Feed(id=504, title="Area 51")
+        feed._manager = self.api.feeds
+        feed._data['feed'] = 'http://api.cosm.com/v2/feeds/504'
+        self.temperature = cosm.Datastream(id="temperature")
+        self.temperature._manager = feed.datastreams
+        self.engine = cosm.rollup.RollupEngine(watermark=30, batch_size=1)
+        self.engine.add(self.temperature, 60, min="min_1m", max="max_1m",
+                        mean="mean_1m", count="count_1m")
+        self.engine.attach(self.api)
+
+    def _create(self, *points):
+        start = datetime(2013, 1, 1)
+        self.temperature.datapoints.create([
+            {'at': start + timedelta(seconds=s), 'value': str(v)}
+            for s, v in points])
+
+    def _written(self):
+        written = {}
+        for args, kwargs in self.session.call_args_list:
+            stream = args[1].split('/')[-2]
+            if stream != "temperature":
+                points = json.loads(kwargs['data'])['datapoints']
+                written.setdefault(stream, []).extend(
+                    (p['at'], p['value']) for p in points)
+        return written
+
+    def test_finished_periods_are_written(self):
+        self._create((0, 1), (20, 3), (50, 2), (70, 10))
+        self.assertEqual(self._written(), {})
+        self._create((95, 5))
+        at = "2013-01-01T00:00:00Z"
+        self.assertEqual(self._written(), {
+            "min_1m": [(at, 1.0)], "max_1m": [(at, 3.0)],
+            "mean_1m": [(at, 2.0)], "count_1m": [(at, 3)],
+        })
+        self.engine.close()
+        self.assertEqual(self._written()["mean_1m"][1],
+                         ("2013-01-01T00:01:00Z", 7.5))
+        self.assertEqual(self.engine.stats['written'], 8)
+
+    def test_late_datapoints_within_the_watermark(self):
+        self._create((30, 1), (70, 4))
+        self._create((10, 7))
+        self._create((95, 5))
+        self._create((40, 100), (45, "n/a"))
+        written = self._written()
+        self.assertEqual(written["max_1m"], [("2013-01-01T00:00:00Z", 7.0)])
+        self.assertEqual(self.engine.stats['late'], 1)
+        self.assertEqual(self.engine.stats['invalid'], 1)
+
+    def test_own_writes_are_not_rolled_up(self):
+        self.engine.add(self._derived("mean_1m"), 3600, count="count_1h")
+        self._create((0, 1), (95, 5))
+        self.engine.close()
+        self.assertFalse("count_1h" in self._written())
+
+    def test_failed_writes_stay_pending(self):
+        self._create((0, 1), (20, 3))
+        self.session.side_effect = requests.ConnectionError()
+        points = [cosm.Datapoint(at=datetime(2013, 1, 1, 0, 1, 35),
+                                 value="5")]
+        self.engine.record(self.temperature.datapoints, points)
+        self.assertEqual(self.engine.stats['written'], 0)
+        self.session.side_effect = None
+        self.session.reset_mock()
+        self.engine.flush()
+        self.assertEqual(self._written()["mean_1m"],
+                         [("2013-01-01T00:00:00Z", 2.0)])
+        self.assertEqual(self.engine.stats['written'], 4)
+
+    def _derived(self, id):
+        datastream = cosm.Datastream(id=id)
+        datastream._manager = self.temperature._manager
+        return datastream
+
+
+@unittest.skipIf(msgpack is None, "msgpack is required")
+class CodecTest(BaseTestCase):
+
+    def setUp(self):
+        super(CodecTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.feed = cosm.Feed(
+            title="Area 51", id=504, updated=datetime(2013, 1, 4, 10, 22),
+            feed='http://api.cosm.com/v2/feeds/504',
+            datastreams=[cosm.Datastream(id="energy", current_value="42",
+                                         datapoints=[])])
+        self.feed._manager = self.api.feeds
+        start = datetime(2013, 1, 1, 14, 14, 55, 118845)
+        self.feed._data['datastreams'][0].datapoints = [
+            cosm.Datapoint(at=start + timedelta(seconds=i), value=str(i))
+            for i in range(100)]
+
+    def test_round_trip(self):
+        feed = cosm.codec.loads(cosm.codec.dumps(self.feed))
+        self.assertEqual(feed.title, "Area 51")
+        self.assertEqual(feed.updated, datetime(2013, 1, 4, 10, 22))
+        (datastream,) = feed._data['datastreams']
+        self.assertEqual(datastream.current_value, "42")
+        self.assertEqual([(d.at, d.value) for d in datastream.datapoints],
+                         [(d.at, d.value) for d in
+                          self.feed._data['datastreams'][0].datapoints])
+        self.assertEqual(getattr(feed, '_manager', None), None)
+
+    def test_smaller_than_json(self):
+        encoded = cosm.codec.dumps(self.feed)
+        self.assertTrue(len(encoded) <
+                        len(json.dumps(self.feed, cls=cosm.JSONEncoder)) / 2)
+
+    def test_rebinding_to_a_client(self):
+        feed = cosm.codec.loads(cosm.codec.dumps(self.feed), api=self.api)
+        feed.datastreams["energy"].datapoints.create([{
+            'at': datetime(2013, 1, 2), 'value': 1}])
+        self.assertEqual(self.session.call_args[0], (
+            'POST',
+            'http://api.cosm.com/v2/feeds/504/datastreams/energy/datapoints'))
+        datastream = cosm.codec.loads(
+            cosm.codec.dumps(feed.datastreams[0]), api=self.api)
+        datastream.update()
+        self.assertEqual(self.session.call_args[0], (
+            'PUT', 'http://api.cosm.com/v2/feeds/504/datastreams/energy'))
+        datapoint = cosm.codec.loads(
+            cosm.codec.dumps(feed.datastreams[0].datapoints[0]),
+            api=self.api)
+        datapoint.delete()
+        self.assertEqual(self.session.call_args[0], (
+            'DELETE', 'http://api.cosm.com/v2/feeds/504/datastreams/energy/'
+            'datapoints/2013-01-01T14:14:55.118845Z'))
+
+    def test_triggers_and_lists(self):
+        trigger = cosm.Trigger(504, "energy", "http://example.com/", "gt",
+                               threshold_value=10)
+        trigger._data['notified_at'] = datetime(2013, 1, 1)
+        datapoint = cosm.Datapoint(at=datetime(2013, 1, 1), value=1)
+        loaded, point = cosm.codec.loads(
+            cosm.codec.dumps([trigger, datapoint]), api=self.api)
+        self.assertEqual(loaded._data, trigger._data)
+        self.assertEqual(loaded._manager, self.api.triggers)
+        self.assertEqual((point.at, point.value), (datetime(2013, 1, 1), 1))
+
+    def test_pickle(self):
+        feed = pickle.loads(pickle.dumps(self.feed))
+        self.assertEqual(feed.title, "Area 51")
+        self.assertEqual(feed._data['datastreams'][0].datapoints[99].value,
+                         "99")
+
+
+class ResilienceTest(BaseTestCase):
+
+    def setUp(self):
+        super(ResilienceTest, self).setUp()
+        self.api = cosm.api.Client("API_KEY")
+        self.clock = FakeClock()
+
+    def _response(self, status_code=200):
+        response = requests.Response()
+        response.status_code = status_code
+        return response
+
+    def test_endpoint(self):
+        endpoint = cosm.resilience.endpoint
+        self.assertEqual(endpoint('feeds'), 'feeds')
+        self.assertEqual(endpoint('feeds/504/datastreams'), 'datastreams')
+        self.assertEqual(
+            endpoint('http://api.cosm.com/v2/feeds/504/datastreams/1'
+                     '/datapoints/2013-01-01T00:00:00Z'), 'datapoints')
+        self.assertEqual(endpoint('triggers/3'), 'triggers')
+        self.assertEqual(endpoint('keys'), None)
+        self.assertRaises(ValueError, cosm.resilience.Resilience,
+                          keys={'hedge': False})
+
+    def test_slow_get_is_hedged(self):
+        resilience = cosm.resilience.Resilience(min_requests=1,
+                                                min_hedge_delay=0.01)
+        resilience.attach(self.api)
+        self.session.return_value = self._response()
+        self.api.client.get('feeds/504')
+        release = threading.Event()
+        slow, fast = self._response(), self._response()
+        slow.raw = Mock()
+        calls = []
+
+        def request(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                release.wait(5)
+                return slow
+            return fast
+
+        self.session.side_effect = request
+        self.assertTrue(self.api.client.get('feeds/504') is fast)
+        release.set()
+        for _ in range(100):
+            if slow.raw.close.called:
+                break
+            time.sleep(0.01)
+        self.assertTrue(slow.raw.close.called)
+        self.assertEqual(len(calls), 2)
+        metrics = resilience.metrics()['feeds']
+        self.assertEqual(metrics['requests'], 2)
+        self.assertEqual(metrics['hedged'], 1)
+        self.assertEqual(metrics['hedge_wins'], 1)
+
+    def test_writes_and_disabled_endpoints_are_not_hedged(self):
+        resilience = cosm.resilience.Resilience(
+            min_requests=1, min_hedge_delay=0.01, feeds={'hedge': False})
+        resilience.attach(self.api)
+        self.session.return_value = self._response()
+        self.api.client.get('feeds/504/datastreams/1')
+        self.session.side_effect = lambda *args, **kwargs: (
+            time.sleep(0.05), self._response())[1]
+        self.api.client.put('feeds/504/datastreams/1', data={})
+        self.api.client.get('feeds/504')
+        self.assertEqual(self.session.call_count, 3)
+        metrics = resilience.metrics()
+        self.assertEqual(metrics['datastreams']['hedged'], 0)
+        self.assertEqual(metrics['feeds']['hedged'], 0)
+        self.assertEqual(metrics['feeds']['hedge_delay'], None)
+
+    def test_concurrent_gets_are_not_limited_by_hedges(self):
+        resilience = cosm.resilience.Resilience(
+            min_requests=1, min_hedge_delay=0.05, max_hedges=2)
+        resilience.attach(self.api)
+        self.session.return_value = self._response()
+        self.api.client.get('feeds/504')
+        self.session.side_effect = lambda *args, **kwargs: (
+            time.sleep(0.1), self._response())[1]
+        started = time.time()
+        cosm.utils.map_concurrently(
+            lambda i: self.api.client.get('feeds/504'), range(16),
+            workers=16)
+        self.assertTrue(time.time() - started < 0.5)
+        metrics = resilience.metrics()['feeds']
+        self.assertEqual(metrics['requests'], 17)
+        self.assertTrue(metrics['hedged'] <= 2)
+        self.assertEqual(metrics['hedged'] + metrics['hedge_skipped'], 16)
+        self.assertEqual(self.session.call_count, 17 + metrics['hedged'])
+
+    def test_circuit_opens_on_failures(self):
+        resilience = cosm.resilience.Resilience(
+            min_requests=2, failure_rate=0.5, cooldown=30, clock=self.clock,
+            hedge=False)
+        resilience.attach(self.api)
+        self.session.return_value = self._response(503)
+        for _ in range(2):
+            self.assertRaises(requests.HTTPError, self.api.feeds.delete, 504)
+        self.assertRaises(cosm.resilience.CircuitOpen, self.api.feeds.delete,
+                          504)
+        self.api.client.get('triggers')
+        self.assertEqual(self.session.call_count, 3)
+        self.clock.sleep(30)
+        self.session.return_value = self._response()
+        self.api.feeds.delete(504)
+        metrics = resilience.metrics()['feeds']
+        self.assertEqual(metrics['state'], 'closed')
+        self.assertEqual(metrics['rejected'], 1)
+        self.assertEqual(metrics['opened'], 1)
+        self.assertEqual(metrics['errors'], 2)
+
+    def test_failed_trial_reopens_circuit(self):
+        resilience = cosm.resilience.Resilience(
+            min_requests=1, cooldown=10, clock=self.clock)
+        resilience.attach(self.api)
+        self.session.side_effect = requests.ConnectionError
+        self.assertRaises(requests.ConnectionError, self.api.client.get,
+                          'triggers/1')
+        self.clock.sleep(10)
+        self.assertRaises(requests.ConnectionError, self.api.client.get,
+                          'triggers/1')
+        self.assertRaises(cosm.resilience.CircuitOpen, self.api.client.get,
+                          'triggers/1')
+        self.assertEqual(resilience.metrics()['triggers']['state'], 'open')
+
+
 # Data used to return in the responses.
 
 GET_FEED_JSON = b'''
@@ -832,3 +2584,25 @@ GET_TRIGGER_JSON = b'''
   "stream_id":"0"
 }
 '''
+
+TRIGGER_NOTIFICATION_JSON = '''
+{
+  "id": 1,
+  "url": "http://api.cosm.com/v2/triggers/1",
+  "type": "gt",
+  "threshold_value": "20",
+  "timestamp": "2010-07-07T13:51:21Z",
+  "environment": {
+    "id": 504,
+    "title": "Cosm Office environment",
+    "feed": "http://api.cosm.com/v2/feeds/504",
+    "status": "live"
+  },
+  "triggering_datastream": {
+    "id": "0",
+    "url": "http://api.cosm.com/v2/feeds/504/datastreams/0",
+    "value": {"value": "23.3", "max_value": "24.1", "min_value": "0.0"},
+    "at": "2010-07-07T13:51:20.123456Z"
+  }
+}
+'''